@@ -1,7 +1,7 @@
 #!/bin/bash
 
 if [ "$1" == "app" ]; then
-  exec gunicorn --bind=0.0.0.0:5000 --worker-class eventlet -w 1 --timeout 600 watchtogether.wsgi:app
+  exec gunicorn --bind=0.0.0.0:${APP_PORT:-5000} --worker-class eventlet -w 1 --timeout 600 watchtogether.wsgi:app
 fi
 
 if [ "$1" == "workers" ]; then
@@ -9,7 +9,7 @@ if [ "$1" == "workers" ]; then
 fi
 
 if [ "$1" == "celery" ]; then
-  exec celery -A watchtogether.tasks.celery worker --loglevel=info --concurrency=2
+  exec celery -A watchtogether.tasks.celery worker --beat --loglevel=info --concurrency=2
 fi
 
 exec bash
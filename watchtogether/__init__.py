@@ -5,6 +5,7 @@ import sys
 import time
 import json
 
+import redis
 from flask import Flask, request, make_response
 from werkzeug.contrib.fixers import ProxyFix
 from flask_socketio import SocketIO
@@ -14,95 +15,236 @@ from watchtogether.config import settings
 from watchtogether.api import flask_api
 
 socketio = SocketIO()
+room_redis = redis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
+
+# Room state lives in Redis so every app process and node sees the same
+# rooms. These only cache the Room objects and the connections this process
+# holds itself, with sticky sessions a connection never moves.
 rooms = {}
 
+# The names of the rooms every connection joined, so a disconnect doesn't
+# have to look through all of them.
+sid_rooms = {}
+
+# Refreshes the connections of this process in Redis, the ones a process
+# that went away held age out by themselves.
+member_heartbeat = None
+
+def refresh_members():
+    while True:
+        socketio.sleep(settings.ROOM_MEMBER_TTL / 3)
+        expires = time.time() + settings.ROOM_MEMBER_TTL
+
+        try:
+            pipe = room_redis.pipeline(transaction=False)
+            for room in list(rooms.values()):
+                if room.sids:
+                    pipe.zadd(f'{room.key}:alive', {sid: expires for sid in room.sids}, xx=True)
+            pipe.execute()
+        except redis.exceptions.RedisError as e:
+            print(f"Refreshing room members failed: {e}")
+
 class Room:
+    __slots__ = ['name', 'key', 'sids', 'video', 'timer']
+
+    # Every connection is a member on its own, with an expiry its process
+    # keeps pushing ahead. Expired members are dropped before the others
+    # are looked at.
+    prune = """
+        local dead = redis.call('zrangebyscore', KEYS[2], '-inf', ARGV[1])
+        if #dead > 0 then
+            redis.call('zremrangebyscore', KEYS[2], '-inf', ARGV[1])
+            redis.call('hdel', KEYS[1], unpack(dead))
+        end
+    """
+
+    has_user = """
+        local function has_user(username)
+            for _, name in ipairs(redis.call('hvals', KEYS[1])) do
+                if name == username then
+                    return true
+                end
+            end
+            return false
+        end
+    """
+
+    join_script = prune + has_user + """
+        local present = has_user(ARGV[3])
+        redis.call('hset', KEYS[1], ARGV[2], ARGV[3])
+        redis.call('zadd', KEYS[2], ARGV[4], ARGV[2])
+        redis.call('expire', KEYS[1], ARGV[5])
+        redis.call('expire', KEYS[2], ARGV[5])
+        return present and 0 or 1
+    """
+
+    leave_script = prune + has_user + """
+        redis.call('hdel', KEYS[1], ARGV[2])
+        redis.call('zrem', KEYS[2], ARGV[2])
+        return has_user(ARGV[3]) and 0 or 1
+    """
+
+    users_script = prune + """
+        return redis.call('hvals', KEYS[1])
+    """
+
     def __init__(self, name, video):
         self.name = name
-        self.users = {}
-        self.last = "system"
-        self.messages = []
+        self.key = f'room:{name}'
+        self.sids = {}
         self.video = video
-        self.timer = Timer(video.duration)
+        self.timer = Timer(f'{self.key}:timer', video.duration)
+
+    @staticmethod
+    def get(name):
+        if name not in rooms:
+            from watchtogether.database import models, db_session
+
+            video = db_session.query(models.Video).filter_by(id=name).one_or_none()
+            if not video:
+                return None
+
+            rooms[name] = Room(name, video)
+
+        return rooms[name]
+
+    @staticmethod
+    def rooms_for_sid(sid):
+        return [rooms[name] for name in sid_rooms.get(sid, ()) if name in rooms]
+
+    @property
+    def last(self):
+        return room_redis.get(f'{self.key}:last') or "system"
+
+    @last.setter
+    def last(self, username):
+        room_redis.set(f'{self.key}:last', username or "system", ex=settings.ROOM_STATE_TTL)
+
+    def members(self, script, *args):
+        return room_redis.eval(script, 2, f'{self.key}:sids', f'{self.key}:alive', time.time(), *args)
 
     def join(self, sid, username):
-        if username in self.users:
-            self.users[username].append(sid)
+        global member_heartbeat
+
+        # Joining again under another name
+        if self.sids.get(sid, username) != username:
+            self.leave(sid)
+
+        new_sid = sid not in self.sids
+        self.sids[sid] = username
+        sid_rooms.setdefault(sid, set()).add(self.name)
+
+        if not new_sid:
             return False
-        else:
-            self.users[username] = [sid]
-            return True
+
+        if not member_heartbeat:
+            member_heartbeat = socketio.start_background_task(refresh_members)
+
+        # A user only joins once, whichever processes hold their connections
+        expires = time.time() + settings.ROOM_MEMBER_TTL
+        return bool(self.members(self.join_script, sid, username, expires, settings.ROOM_STATE_TTL))
 
     def leave(self, sid):
-        for username, sids in self.users.items():
-            if sid in sids:
-                sids.remove(sid)
-                if len(sids) == 0:
-                    self.users.pop(username, None)
-                    return True
-                else:
-                    return False
+        username = self.sids.pop(sid, None)
+        if username is None:
+            return False
+
+        names = sid_rooms.get(sid)
+        if names is not None:
+            names.discard(self.name)
+            if not names:
+                del sid_rooms[sid]
 
-        return False
+        return bool(self.members(self.leave_script, sid, username))
 
     def message(self, username, text):
         message = f"<li><b>{username}: </b>{text}</li>"
-        self.messages.append(message)
+
+        pipe = room_redis.pipeline()
+        pipe.rpush(f'{self.key}:messages', message)
+        pipe.ltrim(f'{self.key}:messages', -20, -1)
+        pipe.expire(f'{self.key}:messages', settings.ROOM_STATE_TTL)
+        pipe.execute()
+
         return message
 
     def get_messages(self):
-        return self.messages[-20:]
+        return room_redis.lrange(f'{self.key}:messages', 0, -1)
 
     def get_user_by_sid(self, sid):
-        for username, sids in self.users.items():
-            if sid in sids:
-                return username
-        return None
+        return self.sids.get(sid)
 
     def has_sid(self, sid):
-        for username, sids in self.users.items():
-            if sid in sids:
-                return True
-        return False
+        return sid in self.sids
 
     def get_users(self):
-        return list(self.users.keys())
+        return list(dict.fromkeys(self.members(self.users_script)))
 
 class Timer:
-    def __init__(self, end):
-        self.time = 0
+    # The position is kept as an offset into the video and the wall clock
+    # time it was taken at, any process can work out where playback is from
+    # that. Nodes need their clocks in sync for this.
+    __slots__ = ['key', 'end', 'running']
+
+    update_script = """
+        local now, op, value = tonumber(ARGV[1]), ARGV[2], tonumber(ARGV[3])
+        local state = redis.call('hmget', KEYS[1], 'offset', 'epoch', 'running')
+        local offset = tonumber(state[1]) or 0
+        local running = state[3] == '1'
+        local stop = tonumber(ARGV[4])
+
+        if running then
+            offset = math.min(offset + now - (tonumber(state[2]) or now), stop)
+            running = offset < stop
+        end
+
+        if op == 'start' then
+            running = true
+        elseif op == 'pause' then
+            running = false
+        elseif op == 'set' then
+            offset = math.max(0, value)
+        elseif op == 'reset' then
+            offset = 0
+        end
+
+        redis.call('hmset', KEYS[1], 'offset', string.format('%.3f', offset), 'epoch', ARGV[1], 'running', running and '1' or '0')
+        redis.call('expire', KEYS[1], ARGV[5])
+    """
+
+    def __init__(self, key, end):
+        self.key = key
         self.end = float(end)
-        self.last = time.monotonic()
         self.running = False
 
-    def get(self):
+    def state(self):
+        offset, epoch, running = room_redis.hmget(self.key, 'offset', 'epoch', 'running')
+        position = float(offset or 0)
+        self.running = running == '1'
+
         if self.running:
-            now = time.monotonic()
-            self.time = self.time + now - self.last
-            self.last = now
+            position = min(position + time.time() - float(epoch), self.end)
+            self.running = position < self.end
+
+        return position, self.running
 
-            if self.time >= self.end:
-                self.time = self.end
-                self.running = False
+    def get(self):
+        return self.state()[0]
 
-        return self.time
+    def update(self, op, value=0):
+        room_redis.eval(self.update_script, 1, self.key, repr(time.time()), op, value, self.end, settings.ROOM_STATE_TTL)
 
     def set(self, value):
-        self.last = time.monotonic()
-        self.time = max(0, value)
+        self.update('set', value)
 
     def start(self):
-        if not self.running:
-            self.last = time.monotonic()
-            self.running = True
+        self.update('start')
 
     def pause(self):
-        self.time = self.get()
-        self.running = False
+        self.update('pause')
 
     def reset(self):
-        self.last = time.monotonic()
-        self.time = 0
+        self.update('reset')
 
 def create_app():
     app = Flask(__name__, instance_relative_config=True)
@@ -121,7 +263,7 @@ def create_app():
     from .main import main as main_blueprint
     app.register_blueprint(main_blueprint)
 
-    socketio.init_app(app)
+    socketio.init_app(app, message_queue=settings.SOCKETIO_MESSAGE_QUEUE)
     flask_api.init_app(app)
 
     from watchtogether.database import db_session
@@ -1,3 +1,15 @@
+from flask import url_for
+from flask import current_app as app
+
+def media_url(path):
+    baseurl = url_for('static', filename='movies/', _external=True)
+    if app.config['STORAGE_BACKEND'] == 'S3':
+        baseurl = app.config['S3_BUCKET_URL']
+        if not baseurl.endswith("/"):
+            baseurl = baseurl + "/"
+
+    return f'{baseurl}{path}'
+
 def ValidValueParser(name, value, valid):
     value = value.strip()
 
@@ -14,6 +26,6 @@ from .video_file import *
 from .subtitle import *
 
 __all__ = [
-    'VideoList', 'Video', 'VideoFile', 'Subtitle', 'SubtitleList', 'SubtitleFile'
+    'VideoList', 'Video', 'VideoFile', 'VideoFileFingerprint', 'Subtitle', 'SubtitleList', 'SubtitleFile'
 ]
 
@@ -12,13 +12,20 @@ from watchtogether.auth import ownerid
 from watchtogether.database import models, db_session
 from watchtogether import tasks
 
-from . import ValidValueParser
+from . import ValidValueParser, media_url
 from.subtitle_file import SubtitleFile, SubtitleFileUrl
 
 class SubtitleUrl(fields.Raw):
     def output(self, key, obj):
         return flask_api.url_for(Subtitle, video_id=obj.video_id, subtitle_id=int(obj.id), _external=True)
 
+class SubtitleWebVTTUrl(fields.Raw):
+    def output(self, key, obj):
+        if not obj.encoded_file:
+            return None
+
+        return media_url(obj.encoded_file)
+
 def LanguageParser(value):
     value = value.strip()
 
@@ -32,6 +39,8 @@ subtitle_fields = {
     'file_url': SubtitleFileUrl,
     'title': fields.String,
     'language': fields.String,
+    'internal': fields.Boolean,
+    'webvtt_url': SubtitleWebVTTUrl,
 }
 
 new_subtitle_parser = reqparse.RequestParser()
@@ -32,5 +32,7 @@ class SubtitleFile(Resource):
         file = request.files['file']
         filename = f'{video.id}_sub_{subtitle.id}_orig'
         file.save(os.path.join(app.config['MOVIE_PATH'], filename))
-        subtitle.orig_file_name = filename
+        subtitle.orig_file = filename
         db_session.commit()
+
+        tasks.convert_subtitle.delay(subtitle.id)
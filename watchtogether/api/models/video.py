@@ -12,7 +12,7 @@ from watchtogether.auth import ownerid
 from watchtogether.database import models, db_session
 from watchtogether import tasks
 
-from . import ValidValueParser
+from . import ValidValueParser, media_url
 from.video_file import VideoFile, VideoFileUrl
 from.subtitle import SubtitleList, subtitle_fields
 
@@ -28,6 +28,23 @@ class VideoUrl(fields.Raw):
     def output(self, key, obj):
         return flask_api.url_for(Video, video_id=obj.id, _external=True)
 
+class ThumbnailsUrl(fields.Raw):
+    def output(self, key, obj):
+        if not obj.thumbnails:
+            return None
+
+        return media_url(obj.thumbnails)
+
+class PosterUrl(fields.Raw):
+    def output(self, key, obj):
+        if not obj.poster_file:
+            return None
+
+        if app.config['STORAGE_BACKEND'] == 'S3':
+            return media_url(obj.poster_file)
+
+        return url_for('main.poster', video_id=obj.id, filename=os.path.basename(obj.poster_file), _external=True)
+
 def VideoTuneParser(value):
     valid = ['film', 'animation', 'grain']
     return ValidValueParser('Tune', value, valid)
@@ -41,6 +58,8 @@ video_fields = {
     'file_url': VideoFileUrl,
     'watch_url': VideoWatchUrl,
     'subtitles_url': SubtitlesListUrl,
+    'thumbnails_url': ThumbnailsUrl,
+    'poster_url': PosterUrl,
     'id': fields.String,
     'title': fields.String,
     'width': fields.Integer,
@@ -50,6 +69,7 @@ video_fields = {
     'encoding_speed': fields.Float,
     'status': fields.String,
     'status_message': fields.String,
+    'watchable': fields.Boolean,
     'tune': fields.String,
     'default_subtitles': fields.Boolean,
     'orig_file_name': fields.String,
@@ -107,10 +127,14 @@ class Video(Resource):
 
             if status == 'start-encoding':
                 if video.status in ['file-uploaded', 'ready', 'error']:
+                    result = tasks.queue_transcode(video.id)
+                    if not result:
+                        abort(409, 'Video is already being encoded')
+
                     video.status = status
                     video.encoding_progress = 0
                     video.status_error =""
-                    video.celery_taskid = tasks.transcode.delay(video.id)
+                    video.celery_taskid = result
                 else:
                     abort(409, 'Cannot start encoding while video is in this state')
 
@@ -128,21 +152,12 @@ class Video(Resource):
         if video.status in ['encoding', 'start-encoding']:
             abort(409, 'Cannot delete while encoding')
 
-        try:
-            if (video.playlist):
-                rm_f(video.playlist)
-
-            if (video.orig_file):
-                rm_f(os.path.join(app.config['MOVIE_PATH'], video.orig_file))
-
-            if app.config['STORAGE_BACKEND'] == 'S3':
-                tasks.s3_delete.delay(video.id)
-            else:
-                viddir = f"{app.config['MOVIE_PATH']}/{video.id}"
-                shutil.rmtree(viddir, ignore_errors = True)
-        except:
-            abort(500)
+        # Removing a fully encoded video can mean unlinking thousands of
+        # files, leave that to a worker instead of blocking the event loop.
+        tasks.delete_video.delay(video.id)
 
+        for row in video.encoded_files + video.encoding_units + video.ladder_stats + video.subtitles:
+            db_session.delete(row)
         db_session.delete(video)
         db_session.commit()
 
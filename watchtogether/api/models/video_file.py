@@ -1,18 +1,30 @@
 import shutil
 import os
+import hmac
+import hashlib
+import secrets
 
+import redis
 from flask import request, redirect, session
 from flask import current_app as app
 from flask_restful import Resource, marshal_with, reqparse, fields, marshal, abort
 from pathlib import Path
 
 from watchtogether.api import flask_api
-from watchtogether.util import rm_f, is_video_file, get_video_title
+from watchtogether.util import rm_f, fallocate, link_or_copy, upload_key, ffprobe, is_video_file, index_first, get_video_title
 from watchtogether.config import settings
 from watchtogether.auth import ownerid
 from watchtogether.database import models, db_session
 from watchtogether import tasks
 
+upload_redis = redis.Redis.from_url(settings.REDIS_URL)
+
+try:
+    from eventlet.tpool import execute
+except ModuleNotFoundError:
+    def execute(f, *args):
+        return f(*args)
+
 class VideoFileUrl(fields.Raw):
     def output(self, key, obj):
         return flask_api.url_for(VideoFile, video_id=obj.id, _external=True)
@@ -20,18 +32,173 @@ class VideoFileUrl(fields.Raw):
 def get_chunk_name(uploaded_filename, chunk_number):
     return uploaded_filename + '_part_%03d' % chunk_number
 
-def is_hole(fh, offset):
-    return os.lseek(fh, offset, os.SEEK_HOLE) == offset
-
 def target_name(video_id):
     return Path(app.config['MOVIE_PATH']) / f'{video_id}_orig'
 
-def update_video_metadata(video, filename):
-    title = get_video_title(filename)
+def chunks_name(video_id):
+    return Path(app.config['MOVIE_PATH']) / f'{video_id}_orig.chunks'
+
+def reset_upload(video_id, upload_identifier):
+    key = upload_key(video_id, upload_identifier)
+    upload_redis.delete(key, f'{key}:complete')
+
+def update_video_metadata(video, filename, complete=True):
+    title = get_video_title(filename, cache=complete)
     if title:
         video.title = title
     db_session.commit()
 
+def record_chunk_digest(video_id, chunk_number, digest):
+    fd = os.open(chunks_name(video_id), os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        os.pwrite(fd, digest, (chunk_number - 1) * len(digest))
+    finally:
+        os.close(fd)
+
+def preallocate(filename, size):
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        execute(fallocate, fd, size)
+    finally:
+        os.close(fd)
+
+def write_block(fd, block, offset, digest):
+    digest.update(block)
+    view = memoryview(block)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset = offset + written
+
+def write_chunk(fd, stream, offset):
+    # Reading the request is left to the event loop, hashing and writing each
+    # block happens on a thread so the disk never stalls other requests.
+    digest = hashlib.sha256()
+    while True:
+        block = stream.read(1024 * 1024)
+        if not block:
+            break
+
+        execute(write_block, fd, block, offset, digest)
+        offset = offset + len(block)
+
+    return digest.digest()
+
+def content_fingerprint(video_id, total_chunks):
+    # The fingerprint is the SHA-256 of the SHA-256 of every upload chunk, so
+    # it can be built from chunks arriving in any order and a client can work
+    # it out without sending anything.
+    try:
+        with open(chunks_name(video_id), 'rb') as f:
+            digests = f.read()
+    except FileNotFoundError:
+        return None
+
+    if len(digests) != total_chunks * 32:
+        return None
+
+    for offset in range(0, len(digests), 32):
+        if digests[offset:offset + 32] == bytes(32):
+            return None
+
+    return hashlib.sha256(digests).hexdigest()
+
+def find_source(content_hash, video_id=None):
+    videos = db_session.query(models.Video).filter(
+        models.Video.content_hash == content_hash,
+        models.Video.id != video_id,
+        models.Video.orig_file != None,
+        models.Video.status.notin_(['file-waiting', 'file-uploading']),
+    ).all()
+
+    for video in videos:
+        source = Path(app.config['MOVIE_PATH']) / video.orig_file
+        if source.exists():
+            return source
+
+    return None
+
+def deduplicate_orig_file(video, filename):
+    source = find_source(video.content_hash, video.id)
+    if not source:
+        return
+
+    tmp_name = f'{filename}.link'
+    try:
+        os.link(source, tmp_name)
+        os.replace(tmp_name, filename)
+    except OSError:
+        rm_f(tmp_name)
+
+def finish_upload(video, filename):
+    if not is_video_file(filename):
+        video.status = 'error'
+        video.status_message = 'File uploaded was not a video file. Please use a different file.'
+        db_session.commit()
+        return {'message': video.status_message}, 501
+
+    update_video_metadata(video, filename)
+
+    video.status = 'file-uploaded'
+    video.encoding_progress = 0
+    discard_encodes(video)
+    db_session.commit()
+
+def discard_encodes(video):
+    # Encodes are only matched on their command, they must not outlive the
+    # file they were made from.
+    video.watchable = False
+    video.poster_file = None
+    for encoded_file in video.encoded_files:
+        rm_f(os.path.join(app.config['MOVIE_PATH'], video.id, encoded_file.encoded_file_name))
+        db_session.delete(encoded_file)
+
+def can_follow_upload(filename, prefix):
+    # ffmpeg reads a file that is still uploading from start to end, so the
+    # container has to be readable without seeking to its index.
+    if not is_video_file(filename, cache=False):
+        return False
+
+    format_name = ffprobe(filename, cache=False)['format'].get('format_name', '')
+    if 'mp4' in format_name and not index_first(filename, prefix):
+        return False
+
+    return True
+
+def start_early_encoding(video, filename, key, total_chunks):
+    first_missing = upload_redis.bitpos(key, 0)
+    if first_missing >= total_chunks:
+        return
+
+    prefix = first_missing * app.config['UPLOAD_CHUNK_SIZE']
+    if prefix < app.config['EARLY_ENCODE_MIN_SIZE']:
+        return
+
+    # Probing a partial file on every chunk would be wasteful
+    if not upload_redis.set(f'{key}:probed', 1, nx=True, ex=10):
+        return
+
+    if not can_follow_upload(filename, prefix):
+        return
+
+    with upload_redis.lock(f'upload-lock:{video.id}', timeout=60, blocking_timeout=30):
+        db_session.refresh(video)
+        if video.status != 'file-uploading' or upload_key(video.id, video.upload_identifier) != key:
+            return
+
+        discard_encodes(video)
+        db_session.commit()
+
+        result = tasks.queue_transcode(video.id)
+        if not result:
+            return
+
+        video.status = 'start-encoding'
+        video.encoding_progress = 0
+        video.status_error = ""
+        video.celery_taskid = result
+        db_session.commit()
+
 class VideoFile(Resource):
     def get(self, video_id):
         owner_id = request.cookies.get(app.config['COOKIE_OWNER_ID'])
@@ -46,8 +213,6 @@ class VideoFile(Resource):
         resumableFilename = request.args.get('resumableFilename', default='error', type=str)
         resumableChunkSize = request.args.get('resumableChunkSize', default=0, type=int)
 
-        target_file_name = target_name(video.id)
-
         if not resumableIdentifier or not resumableChunkNumber or not resumableChunkSize:
             return {'message': 'Parameter error'}, 500
 
@@ -57,14 +222,8 @@ class VideoFile(Resource):
         if video.orig_file_name != resumableFilename:
             return {'message': 'Different filename'}, 404
 
-        if not target_file_name.exists():
-            return {'message': 'Chunk not found'}, 404
-
-        with open(target_file_name, "rb") as target_file:
-            offset = (resumableChunkNumber - 1) * resumableChunkSize
-            fh = target_file.fileno()
-            if not is_hole(fh, offset):
-                return 'OK'
+        if upload_redis.getbit(upload_key(video.id, resumableIdentifier), resumableChunkNumber - 1):
+            return 'OK'
 
         return {'message': 'Chunk not found'}, 404
 
@@ -75,71 +234,205 @@ class VideoFile(Resource):
         if not video:
             return {'message': 'Video not found'}, 403
 
-        resumableTotalChunks = request.form.get('resumableTotalChunks', type=int)
-        resumableChunkNumber = request.form.get('resumableChunkNumber', default=1, type=int)
-        resumableIdentifier = request.form.get('resumableIdentifier', default='error', type=str)
-        resumableFilename = request.form.get('resumableFilename', default='error', type=str)
-        resumableTotalSize = request.form.get('resumableTotalSize', default=0, type=int)
-        resumableChunkSize = request.form.get('resumableChunkSize', default=0, type=int)
+        resumableTotalChunks = request.values.get('resumableTotalChunks', type=int)
+        resumableChunkNumber = request.values.get('resumableChunkNumber', default=1, type=int)
+        resumableIdentifier = request.values.get('resumableIdentifier', default='error', type=str)
+        resumableFilename = request.values.get('resumableFilename', default='error', type=str)
+        resumableTotalSize = request.values.get('resumableTotalSize', default=0, type=int)
+        resumableChunkSize = request.values.get('resumableChunkSize', default=0, type=int)
 
         if not resumableIdentifier or not resumableChunkNumber or not resumableTotalSize or not resumableChunkSize:
             return {'message': 'Parameter error'}, 500
 
+        if not resumableTotalChunks or resumableChunkNumber < 1 or resumableChunkNumber > resumableTotalChunks:
+            return {'message': 'Parameter error'}, 500
+
         target_file_name = target_name(video.id)
-        chunk_data = request.files['file']
-
-        if video.status in ['file-waiting', 'file-uploaded', 'ready', 'error']:
-            video.status = 'file-uploading'
-            video.upload_identifier = resumableIdentifier
-            video.orig_file_name = resumableFilename
-            video.orig_file = target_file_name.name
-            db_session.commit()
-                
-        if video.upload_identifier != resumableIdentifier:
-            return {'message': 'Different upload already in progress'}, 409
+        key = upload_key(video.id, resumableIdentifier)
 
+        # resumable.js sends several chunks at once, only let one of them at a
+        # time start a new upload or create the file.
         try:
-            if target_file_name.stat().st_size != resumableTotalSize or video.orig_file_name != resumableFilename:
-                rm_f(target_file_name)
-        except FileNotFoundError:
-            pass
-
-        if not target_file_name.exists():
-            target_file = open(target_file_name, "wb")
-            target_file.truncate(resumableTotalSize)
-            target_file.close()
+            with upload_redis.lock(f'upload-lock:{video.id}', timeout=60, blocking_timeout=30):
+                db_session.refresh(video)
+
+                # A retry or straggler of an upload that already completed,
+                # only a new identifier or a reset to file-waiting replaces it.
+                # An encode that failed while following the upload doesn't
+                # complete it, the rest of the chunks still have to be written.
+                if video.upload_identifier == resumableIdentifier and upload_redis.exists(f'{key}:complete'):
+                    return 'OK'
+
+                # The encode that followed this upload failed, the upload
+                # itself carries on and finishes like any other.
+                if video.upload_identifier == resumableIdentifier and video.status == 'error' and upload_redis.exists(key):
+                    video.status = 'file-uploading'
+                    db_session.commit()
+
+                if video.status in ['file-waiting', 'file-uploaded', 'ready', 'error']:
+                    video.status = 'file-uploading'
+                    video.upload_identifier = resumableIdentifier
+                    video.orig_file_name = resumableFilename
+                    video.orig_file = target_file_name.name
+                    video.content_hash = None
+                    db_session.commit()
+
+                    reset_upload(video.id, resumableIdentifier)
+                    rm_f(target_file_name)
+
+                if video.upload_identifier != resumableIdentifier:
+                    return {'message': 'Different upload already in progress'}, 409
+
+                try:
+                    if target_file_name.stat().st_size != resumableTotalSize or video.orig_file_name != resumableFilename:
+                        rm_f(target_file_name)
+                except FileNotFoundError:
+                    pass
+
+                if not target_file_name.exists():
+                    free = shutil.disk_usage(app.config['MOVIE_PATH']).free
+                    if free - resumableTotalSize < app.config['UPLOAD_MIN_FREE']:
+                        return {'message': 'Not enough disk space left for this file'}, 507
+
+                    reset_upload(video.id, resumableIdentifier)
+                    rm_f(chunks_name(video.id))
+                    preallocate(target_file_name, resumableTotalSize)
+        except redis.exceptions.LockError:
+            return {'message': 'Upload is busy, try again'}, 503
 
         upload_complete = False
 
-        with open(target_file_name, "r+b") as target_file:
+        # resumable.js sends the chunk as the raw request body in octet mode,
+        # older clients still send it as a multipart file.
+        if 'file' in request.files:
+            stream = request.files['file'].stream
+        else:
+            stream = request.stream
+
+        fh = os.open(target_file_name, os.O_RDWR)
+        try:
             offset = (resumableChunkNumber - 1) * resumableChunkSize
-            target_file.seek(offset, os.SEEK_SET)
-            target_file.write(chunk_data.read())
+            digest = write_chunk(fh, stream, offset)
+
+            if resumableChunkSize == app.config['UPLOAD_CHUNK_SIZE']:
+                record_chunk_digest(video.id, resumableChunkNumber, digest)
+
+            pipe = upload_redis.pipeline()
+            pipe.setbit(key, resumableChunkNumber - 1, 1)
+            pipe.expire(key, app.config['UPLOAD_ABANDON_AGE'])
+            pipe.bitcount(key)
+            pipe.getbit(key, 0)
+            pipe.getbit(key, resumableTotalChunks - 1)
+            _, _, uploaded_chunks, has_first, has_last = pipe.execute()
+
+            # Every chunk that finds the bitmap full could finish the upload,
+            # only the first one to claim it does.
+            if uploaded_chunks == resumableTotalChunks:
+                if upload_redis.set(f'{key}:complete', 1, nx=True, ex=app.config['UPLOAD_ABANDON_AGE']):
+                    upload_complete = True
+                    execute(os.fsync, fh)
+
+            if resumableTotalSize >= resumableChunkSize and not upload_complete:
+                if (has_first and resumableChunkNumber == resumableTotalChunks) or (has_last and resumableChunkNumber == 1):
+                    update_video_metadata(video, target_file_name, complete=False)
+        finally:
+            os.close(fh)
 
-            fh = target_file.fileno()
+        if upload_complete:
+            db_session.refresh(video)
+            video.content_hash = content_fingerprint(video.id, resumableTotalChunks)
+            rm_f(chunks_name(video.id))
+            if video.content_hash:
+                deduplicate_orig_file(video, target_file_name)
+
+            # Encoding already started while the file was uploading
+            if video.status != 'file-uploading':
+                update_video_metadata(video, target_file_name)
+                return
+
+            return finish_upload(video, target_file_name)
+
+        early_encode = request.values.get('autoEncode', default=0, type=int)
+        if early_encode and app.config['ENCODE_WHILE_UPLOADING'] and resumableChunkSize == app.config['UPLOAD_CHUNK_SIZE']:
+            try:
+                start_early_encoding(video, target_file_name, key, resumableTotalChunks)
+            except redis.exceptions.LockError:
+                pass
+
+fingerprint_parser = reqparse.RequestParser()
+fingerprint_parser.add_argument('content_hash', nullable=False, required=True)
+fingerprint_parser.add_argument('size', type=int, nullable=False, required=True)
+fingerprint_parser.add_argument('filename', nullable=False, required=True)
+
+proof_parser = reqparse.RequestParser()
+proof_parser.add_argument('proof', nullable=False, required=True)
+
+class VideoFileFingerprint(Resource):
+    def put(self, video_id):
+        args = fingerprint_parser.parse_args()
 
-            if os.lseek(fh, 0, os.SEEK_HOLE) == resumableTotalSize:
-                upload_complete = True
+        owner_id = request.cookies.get(app.config['COOKIE_OWNER_ID'])
+        video = db_session.query(models.Video).filter_by(owner=owner_id, id=video_id).one_or_none()
 
-            os.fsync(fh)
+        if not video:
+            return {'message': 'Video not found'}, 403
 
-            last_chunk_offset = resumableTotalChunks * resumableChunkSize
-            if resumableTotalSize >= resumableChunkSize:
-                if (not is_hole(fh, resumableChunkSize - 1) and resumableChunkNumber == resumableTotalChunks) or (not is_hole(fh, resumableTotalSize - 1) and resumableChunkNumber == 1):
-                    update_video_metadata(video, target_file_name)
+        if not video.status in ['file-waiting', 'file-uploaded', 'ready', 'error']:
+            return {'message': 'Cannot replace file in this state'}, 409
 
-        if upload_complete:
-            if not is_video_file(target_file_name):
-                video.status = 'error'
-                video.status_message = 'File uploaded was not a video file. Please use a different file.'
-                db_session.commit()
-                return {'message': video.status_message}, 501
-
-            update_video_metadata(video, target_file_name)
-
-            video.status = 'file-uploaded'
-            video.encoding_progress = 0
-            for encoded_file in video.encoded_files:
-                rm_f(os.path.join(app.config['MOVIE_PATH'], video.id, encoded_file.encoded_file_name))
-                db_session.delete(encoded_file)
-            db_session.commit()
+        source = find_source(args['content_hash'], video.id)
+        if not source or source.stat().st_size != args['size']:
+            return {'message': 'Fingerprint not known'}, 404
+
+        # Knowing a fingerprint isn't the same as having the file, make the
+        # client hash a random piece of it together with a fresh nonce.
+        length = min(1024 * 1024, args['size'])
+        challenge = {
+            'video_id': video.id,
+            'content_hash': args['content_hash'],
+            'filename': args['filename'],
+            'nonce': secrets.token_hex(16),
+            'offset': secrets.randbelow(args['size'] - length + 1),
+            'length': length,
+        }
+        session['fingerprint'] = challenge
+
+        return {'nonce': challenge['nonce'], 'offset': challenge['offset'], 'length': challenge['length']}
+
+    def post(self, video_id):
+        args = proof_parser.parse_args()
+
+        owner_id = request.cookies.get(app.config['COOKIE_OWNER_ID'])
+        video = db_session.query(models.Video).filter_by(owner=owner_id, id=video_id).one_or_none()
+
+        if not video:
+            return {'message': 'Video not found'}, 403
+
+        challenge = session.pop('fingerprint', None)
+        if not challenge or challenge['video_id'] != video.id:
+            return {'message': 'No fingerprint challenge for this video'}, 409
+
+        if not video.status in ['file-waiting', 'file-uploaded', 'ready', 'error']:
+            return {'message': 'Cannot replace file in this state'}, 409
+
+        source = find_source(challenge['content_hash'], video.id)
+        if not source:
+            return {'message': 'Fingerprint not known'}, 404
+
+        with open(source, 'rb') as f:
+            f.seek(challenge['offset'])
+            expected = hashlib.sha256(challenge['nonce'].encode('utf-8') + f.read(challenge['length'])).hexdigest()
+
+        if not hmac.compare_digest(expected, args['proof']):
+            return {'message': 'Fingerprint proof failed'}, 403
+
+        target_file_name = target_name(video.id)
+        link_or_copy(source, target_file_name)
+
+        video.upload_identifier = None
+        video.orig_file_name = challenge['filename']
+        video.orig_file = target_file_name.name
+        video.content_hash = challenge['content_hash']
+        db_session.commit()
+
+        return finish_upload(video, target_file_name)
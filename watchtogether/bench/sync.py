@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+
+# Socket.IO sync load generator
+#
+# Simulates sync.js clients spread over rooms: every client joins, sends a
+# time_get every 10 seconds and every room sees the occasional time_start,
+# time_pause, time_set and chat message. Each stage runs a number of rooms
+# with a number of users each and reports round-trip latency percentiles per
+# event, event loop lag and server CPU and RSS as JSON:
+#
+#   python3 -m watchtogether.bench.sync --spawn --stages 10x10,50x20,200x20
+#   python3 -m watchtogether.bench.sync --url http://127.0.0.1:5000 --server-pid 1234
+#
+# Needs python-socketio with the asyncio client (and aiohttp), in a version
+# that speaks the same protocol as the server's Flask-SocketIO.
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+try:
+    import aiohttp
+    import socketio
+except ModuleNotFoundError:
+    aiohttp = None
+    socketio = None
+
+def percentiles(values):
+    if not values:
+        return {'count': 0}
+
+    values = sorted(values)
+    def at(fraction):
+        return values[min(int(len(values) * fraction), len(values) - 1)] * 1000
+
+    return {'count': len(values), 'p50_ms': at(0.5), 'p99_ms': at(0.99), 'max_ms': values[-1] * 1000}
+
+class ServerMonitor:
+    # Samples CPU time and RSS of the server and everything it started from
+    # /proc, gunicorn does the actual work in a child process.
+    def __init__(self, pid, interval=1):
+        self.pid = pid
+        self.interval = interval
+        self.ticks = os.sysconf('SC_CLK_TCK')
+        self.cpu = []
+        self.rss = []
+
+    def tree(self):
+        pids = [self.pid]
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    stat = f.read().rsplit(')', 1)[1].split()
+            except OSError:
+                continue
+            if int(stat[1]) in pids:
+                pids.append(int(entry))
+
+        return pids
+
+    def sample(self):
+        cpu = 0
+        rss = 0
+        for pid in self.tree():
+            try:
+                with open(f'/proc/{pid}/stat') as f:
+                    stat = f.read().rsplit(')', 1)[1].split()
+                cpu = cpu + int(stat[11]) + int(stat[12])
+                with open(f'/proc/{pid}/status') as f:
+                    for line in f:
+                        if line.startswith('VmRSS:'):
+                            rss = rss + int(line.split()[1])
+            except OSError:
+                continue
+
+        return cpu / self.ticks, rss
+
+    async def run(self):
+        last_cpu, _ = self.sample()
+        last = time.monotonic()
+        while True:
+            await asyncio.sleep(self.interval)
+            cpu, rss = self.sample()
+            now = time.monotonic()
+            self.cpu.append((cpu - last_cpu) / (now - last) * 100)
+            self.rss.append(rss)
+            last_cpu, last = cpu, now
+
+    def report(self):
+        if not self.cpu:
+            return None
+
+        return {
+            'cpu_percent_mean': sum(self.cpu) / len(self.cpu),
+            'cpu_percent_max': max(self.cpu),
+            'rss_kib_max': max(self.rss),
+        }
+
+class LoopLag:
+    # How late a short sleep wakes up, if this grows the load generator
+    # itself is the bottleneck and the latencies can't be trusted.
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.lag = []
+
+    async def run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.lag.append(time.monotonic() - started - self.interval)
+
+class Stage:
+    def __init__(self):
+        self.latency = {}
+        self.sent = {}
+        self.errors = 0
+        self.messages = 0
+
+    def record(self, event, seconds):
+        self.latency.setdefault(event, []).append(seconds)
+
+class LoadClient:
+    def __init__(self, url, stage, room, username, time_get_event='time_get'):
+        self.url = url
+        self.stage = stage
+        self.room = room
+        self.username = username
+        self.time_get_event = time_get_event
+        self.joined = asyncio.Event()
+        self.sio = socketio.AsyncClient(reconnection=False)
+
+        self.sio.on('connected', self.on_connected)
+        self.sio.on('time_get', self.on_time_get)
+        self.sio.on('time_start', self.on_broadcast('time_start'))
+        self.sio.on('time_pause', self.on_broadcast('time_pause'))
+        self.sio.on('time_reset', self.on_broadcast('time_reset'))
+        self.sio.on('message', self.on_message)
+
+    async def connect(self):
+        await self.sio.connect(self.url, transports=['websocket'])
+        self.join_sent = time.monotonic()
+        await self.sio.emit('join', {'username': self.username, 'room': self.room})
+        await asyncio.wait_for(self.joined.wait(), 30)
+
+    async def disconnect(self):
+        await self.sio.disconnect()
+
+    async def on_connected(self, data):
+        self.stage.record('join', time.monotonic() - self.join_sent)
+        self.joined.set()
+
+    async def time_get(self):
+        await self.sio.emit('time_get', {'stamp': time.time() * 1000, 'room': self.room})
+
+    async def on_time_get(self, data):
+        self.stage.record(self.time_get_event, time.time() - data['stamp'] / 1000)
+
+    def on_broadcast(self, event):
+        # Fan out latency, from the moment one member sent it until every
+        # other member got it.
+        async def handler(data):
+            sent = self.stage.sent.get((self.room, event, data.get('username')))
+            if sent:
+                self.stage.record(event, time.monotonic() - sent)
+        return handler
+
+    async def on_message(self, data):
+        sent = self.stage.sent.get((self.room, 'message', data['message'].rsplit(' ', 1)[-1].split('<', 1)[0]))
+        if sent:
+            self.stage.record('message', time.monotonic() - sent)
+
+    async def control(self, event):
+        sent_as = 'time_reset' if event == 'time_set' else event
+        self.stage.sent[(self.room, sent_as, self.username)] = time.monotonic()
+
+        data = {'room': self.room}
+        if event == 'time_set':
+            data['time'] = random.randint(0, 3600)
+        await self.sio.emit(event, data)
+
+    async def message(self):
+        self.stage.messages = self.stage.messages + 1
+        token = f'bench{self.stage.messages}'
+        self.stage.sent[(self.room, 'message', token)] = time.monotonic()
+        await self.sio.emit('message', {'username': self.username, 'room': self.room, 'text': f'load test {token}'})
+
+    async def run(self, interval):
+        # sync.js starts its timer when the video can play, so clients don't
+        # all ask at the same moment.
+        await asyncio.sleep(random.uniform(0, interval))
+        while True:
+            await self.time_get()
+            await asyncio.sleep(interval)
+
+async def room_driver(clients, control_interval, message_interval):
+    # Control events and messages arrive at random per room, on average
+    # once every interval.
+    async def events(interval, action):
+        while True:
+            await asyncio.sleep(random.expovariate(1 / interval))
+            await action(random.choice(clients))
+
+    await asyncio.gather(
+        events(control_interval, lambda client: client.control(random.choice(['time_start', 'time_pause', 'time_set']))),
+        events(message_interval, lambda client: client.message()),
+    )
+
+async def create_rooms(url, count, owner):
+    # Every room is a video, the server only lets clients join existing ones
+    rooms = []
+    async with aiohttp.ClientSession(cookies={'owner_id': owner}) as session:
+        for num in range(count):
+            async with session.put(f'{url}/api/videos/', json={'title': f'load test {num}'}) as response:
+                response.raise_for_status()
+                rooms.append((await response.json())['id'])
+
+    return rooms
+
+async def run_stage(args, rooms, users):
+    stage = Stage()
+    tasks = []
+    clients = []
+
+    room_ids = await create_rooms(args.url, rooms, args.owner)
+
+    semaphore = asyncio.Semaphore(args.connect_concurrency)
+    async def connect(client):
+        async with semaphore:
+            try:
+                await client.connect()
+                return client
+            except Exception as e:
+                stage.errors = stage.errors + 1
+                print(f'Connecting {client.username} failed: {e}')
+                return None
+
+    pending = [LoadClient(args.url, stage, room, f'user{num}-{room}') for room in room_ids for num in range(users)]
+    started = time.monotonic()
+    clients = [c for c in await asyncio.gather(*[connect(c) for c in pending]) if c]
+    connect_seconds = time.monotonic() - started
+    print(f'{len(clients)} clients connected in {connect_seconds:.1f}s')
+
+    # A dedicated probe in a room of its own, how quickly the server answers
+    # a cheap request while it is busy with everything else.
+    probe = LoadClient(args.url, stage, (await create_rooms(args.url, 1, args.owner))[0], 'probe', 'probe')
+    await probe.connect()
+
+    async def run_probe():
+        while True:
+            await probe.time_get()
+            await asyncio.sleep(args.probe_interval)
+
+    monitor = ServerMonitor(args.server_pid) if args.server_pid else None
+    looplag = LoopLag()
+
+    for client in clients:
+        tasks.append(asyncio.ensure_future(client.run(args.time_get_interval)))
+    by_room = {}
+    for client in clients:
+        by_room.setdefault(client.room, []).append(client)
+    for room_clients in by_room.values():
+        tasks.append(asyncio.ensure_future(room_driver(room_clients, args.control_interval, args.message_interval)))
+    tasks.append(asyncio.ensure_future(run_probe()))
+    tasks.append(asyncio.ensure_future(looplag.run()))
+    if monitor:
+        tasks.append(asyncio.ensure_future(monitor.run()))
+
+    await asyncio.sleep(args.duration)
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await asyncio.gather(*[c.disconnect() for c in clients + [probe]], return_exceptions=True)
+
+    return {
+        'rooms': rooms,
+        'users_per_room': users,
+        'clients': len(clients),
+        'connect_errors': stage.errors,
+        'connect_seconds': connect_seconds,
+        'latency': {event: percentiles(values) for event, values in sorted(stage.latency.items())},
+        'client_loop_lag': percentiles(looplag.lag),
+        'server': monitor.report() if monitor else None,
+    }
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def spawn_server(workdir):
+    # The app as entrypoint.sh runs it, with a database of its own
+    port = free_port()
+    env = dict(os.environ)
+    env['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.join(workdir, "loadtest.db")}'
+
+    command = [sys.executable, '-m', 'gunicorn', f'--bind=127.0.0.1:{port}', '--worker-class', 'eventlet', '-w', '1', '--timeout', '600', 'watchtogether.wsgi:app']
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    server = subprocess.Popen(command, env=env, cwd=root, stdout=subprocess.DEVNULL, stderr=open(os.path.join(workdir, 'server.log'), 'w'))
+
+    for attempt in range(100):
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return server, f'http://127.0.0.1:{port}'
+        except OSError:
+            if server.poll() is not None:
+                break
+            time.sleep(0.2)
+
+    server.terminate()
+    raise RuntimeError(f'Server did not start, see {workdir}/server.log')
+
+async def run_load(args):
+    stages = []
+    for stage in args.stages.split(','):
+        rooms, users = stage.split('x')
+        stages.append((int(rooms), int(users)))
+
+    report = {'url': args.url, 'duration': args.duration, 'stages': []}
+    for rooms, users in stages:
+        print(f'Stage: {rooms} rooms with {users} users each')
+        report['stages'].append(await run_stage(args, rooms, users))
+
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the Socket.IO sync events')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='app to test')
+    parser.add_argument('--spawn', action='store_true', help='start a local app instance with a database of its own instead')
+    parser.add_argument('--server-pid', type=int, help='pid of the app to sample CPU and RSS of')
+    parser.add_argument('--stages', default='10x10,50x10,100x20', help='comma separated <rooms>x<users per room>')
+    parser.add_argument('--duration', type=int, default=60, help='seconds every stage runs for')
+    parser.add_argument('--time-get-interval', type=float, default=10, help='seconds between time_gets of a client')
+    parser.add_argument('--control-interval', type=float, default=30, help='mean seconds between start/pause/seeks in a room')
+    parser.add_argument('--message-interval', type=float, default=20, help='mean seconds between chat messages in a room')
+    parser.add_argument('--probe-interval', type=float, default=0.5, help='seconds between time_gets of the latency probe')
+    parser.add_argument('--connect-concurrency', type=int, default=100, help='clients connecting at the same time')
+    parser.add_argument('--owner', default='loadtest', help='owner id the rooms are created as')
+    parser.add_argument('-o', '--output', help='write the JSON report here instead of to stdout')
+    args = parser.parse_args()
+
+    if not socketio:
+        print('The load generator needs python-socketio with the asyncio client and aiohttp')
+        sys.exit(1)
+
+    server = None
+    if args.spawn:
+        workdir = tempfile.mkdtemp(prefix='watchtogether-loadtest-')
+        server, args.url = spawn_server(workdir)
+        args.server_pid = server.pid
+
+    try:
+        report = asyncio.run(run_load(args))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+        print(f'Report written to {args.output}')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+
+# Transcode pipeline benchmark
+#
+# Generates synthetic sources with ffmpeg's lavfi and runs them through
+# FfmpegTranscode and transcode_video the way the transcode task does, with
+# a throwaway SQLite database and moto (or a MinIO endpoint) standing in for
+# S3. The report is JSON with stable key order, so two runs can be diffed:
+#
+#   python3 -m watchtogether.bench.transcode -o before.json
+#   python3 -m watchtogether.bench.transcode -o after.json
+#   python3 -m watchtogether.bench.transcode --compare before.json after.json
+#
+# The optional pipeline modes are off unless a case turns them on with a
+# suffix, like 720p30-stereo-30s+fast+hevc for a fast start pass followed by
+# an h264 and an hevc ladder pass.
+#
+# Every case runs in a fresh interpreter, settings are read from the
+# environment at import time and peak RSS is only meaningful per process.
+# Progress goes to REDIS_URL when a Redis is running there and is dropped
+# otherwise, nothing else needs one. Timing every rung on its own encodes
+# the whole ladder a second time, so that only happens with --rungs.
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+
+resolutions = {
+    '360p': (640, 360),
+    '720p': (1280, 720),
+    '1080p': (1920, 1080),
+}
+
+audio_layouts = {
+    'none': None,
+    'mono': 'mono',
+    'stereo': 'stereo',
+    '5.1': '5.1',
+}
+
+pipeline_modes = {
+    'fast': {'FAST_START': 'true'},
+    'resumable': {'RESUMABLE_ENCODING': 'true'},
+    'hevc': {'EXTRA_LADDER': 'hevc'},
+    'av1': {'EXTRA_LADDER': 'av1'},
+    'vp9': {'EXTRA_LADDER': 'vp9'},
+}
+
+default_cases = [
+    '360p24-stereo-30s',
+    '720p30-stereo-30s',
+    '720p60-mono-30s',
+    '1080p24-5.1-30s',
+    '1080p30-none-30s',
+    '1080p24-stereo-120s',
+    '720p30-stereo-30s+fast+hevc',
+    '720p24-stereo-120s+resumable',
+]
+
+def parse_case(name):
+    # <resolution><fps>-<audio>-<duration>s[+mode...], like 720p30-stereo-30s+fast
+    source, *modes = name.split('+')
+    video, audio, duration = source.rsplit('-', 2)
+    resolution, fps = video.split('p', 1)
+    resolution = f'{resolution}p'
+
+    if resolution not in resolutions or audio not in audio_layouts or not duration.endswith('s'):
+        raise ValueError(f'Unknown benchmark case {name}')
+
+    if any(mode not in pipeline_modes for mode in modes):
+        raise ValueError(f'Unknown pipeline mode in {name}, known modes are {" ".join(pipeline_modes)}')
+
+    width, height = resolutions[resolution]
+    return {'name': name, 'source': source, 'modes': modes, 'width': width, 'height': height, 'fps': int(fps),
+        'audio': audio, 'duration': int(duration[:-1])}
+
+def generate_source(case, cache_dir):
+    # Sources are cached by their parameters, the same case always encodes
+    # the exact same input.
+    filename = os.path.join(cache_dir, f'{case["source"]}.mkv')
+    if os.path.exists(filename):
+        return filename
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Noise keeps the encoder from getting away with the flat test pattern
+    command = ['ffmpeg', '-y', '-nostdin', '-f', 'lavfi', '-i',
+        f'testsrc2=size={case["width"]}x{case["height"]}:rate={case["fps"]}:duration={case["duration"]},noise=alls=12:allf=t']
+
+    layout = audio_layouts[case['audio']]
+    if layout:
+        command.extend(['-f', 'lavfi', '-i', f'sine=frequency=440:beep_factor=4:sample_rate=48000:duration={case["duration"]}',
+            '-filter:a', f'aformat=channel_layouts={layout}'])
+
+    command.extend(['-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '16', '-pix_fmt', 'yuv420p'])
+    if layout:
+        command.extend(['-c:a', 'flac'])
+    command.append(f'{filename}.tmp.mkv')
+
+    print(f'Generating {filename}')
+    subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    os.replace(f'{filename}.tmp.mkv', filename)
+
+    return filename
+
+def dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            size = size + os.path.getsize(os.path.join(root, f))
+
+    return size
+
+def peak_rss():
+    # ru_maxrss is in KiB on Linux, the children are ffmpeg and MP4Box. The
+    # encoder processes are only counted once they have been waited for.
+    import billiard
+    billiard.active_children()
+
+    return {
+        'self_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'children_kib': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+def setup_s3(args):
+    if args.s3 == 'none':
+        return None
+
+    import boto3
+
+    if args.s3 == 'moto':
+        try:
+            from moto import mock_aws
+        except ImportError:
+            from moto import mock_s3 as mock_aws
+
+        mock = mock_aws()
+        mock.start()
+    else:
+        mock = None
+
+    params = {
+        'aws_access_key_id': os.environ['S3_ACCESS_KEY'],
+        'aws_secret_access_key': os.environ['S3_SECRET_KEY'],
+        'region_name': os.environ['S3_REGION'],
+    }
+    if os.environ.get('S3_ENDPOINT_URL'):
+        params['endpoint_url'] = os.environ['S3_ENDPOINT_URL']
+
+    client = boto3.client('s3', **params)
+    try:
+        client.create_bucket(Bucket=os.environ['S3_BUCKET'])
+    except client.exceptions.BucketAlreadyOwnedByYou:
+        pass
+
+    return mock
+
+def case_environment(args, workdir, case):
+    env = dict(os.environ)
+    env.update({
+        'MOVIE_PATH': os.path.join(workdir, 'movies'),
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{os.path.join(workdir, "bench.db")}',
+        'STORAGE_BACKEND': 'files',
+        'PARALLEL_ENCODING': 'none',
+        'RESUMABLE_ENCODING': 'false',
+        'FAST_START': 'false',
+        'EXTRA_LADDER': 'none',
+        'SOCKETIO_MESSAGE_QUEUE': 'none',
+    })
+
+    for mode in case['modes']:
+        env.update(pipeline_modes[mode])
+
+    # Short sources still have to be split into a few checkpointed units
+    if 'resumable' in case['modes']:
+        env['SEGMENT_LENGTH'] = str(max(case['duration'] // 4, 1))
+
+    if args.s3 == 'moto':
+        env.update({
+            'S3_BUCKET': 'watchtogether-bench',
+            'S3_ACCESS_KEY': 'bench',
+            'S3_SECRET_KEY': 'bench',
+            'S3_REGION': 'us-east-1',
+        })
+        env.pop('S3_ENDPOINT_URL', None)
+    elif args.s3 == 'minio':
+        env.setdefault('S3_BUCKET', 'watchtogether-bench')
+        env.setdefault('S3_ACCESS_KEY', 'minioadmin')
+        env.setdefault('S3_SECRET_KEY', 'minioadmin')
+        env.setdefault('S3_REGION', 'us-east-1')
+        env['S3_ENDPOINT_URL'] = args.s3_endpoint
+
+    return env
+
+def run_case(args):
+    # Runs in its own interpreter with the environment set up by the parent
+    case = parse_case(args.run_case)
+    mock = setup_s3(args)
+
+    from watchtogether import database
+    from watchtogether.database import models, db_session, Base
+    from watchtogether import tasks
+
+    Base.metadata.create_all(bind=database.engine)
+
+    movie_path = tasks.celery.conf.get('MOVIE_PATH')
+    os.makedirs(movie_path, exist_ok=True)
+
+    video = models.Video(title=case['name'], owner='benchmark', status='file-uploaded', tune='film')
+    db_session.add(video)
+    db_session.commit()
+
+    video.orig_file = f'{video.id}_orig'
+    os.symlink(os.path.abspath(args.source), os.path.join(movie_path, video.orig_file))
+    db_session.commit()
+
+    outdir = os.path.join(movie_path, video.id)
+    os.makedirs(outdir)
+    result = {'case': case, 'timings': {}}
+
+    started = time.monotonic()
+    ffmpeg = tasks.FfmpegTranscode(video, None, outdir)
+    result['timings']['setup_seconds'] = time.monotonic() - started
+
+    # The same passes the transcode task runs, all on this one instance
+    if ffmpeg.wants_fast_start():
+        started = time.monotonic()
+        ffmpeg.run_fast_start()
+        result['timings']['fast_start_seconds'] = time.monotonic() - started
+
+    started = time.monotonic()
+    if ffmpeg.wants_checkpoints():
+        ffmpeg.run_checkpointed()
+    else:
+        ffmpeg.run()
+    result['timings']['encode_seconds'] = time.monotonic() - started
+    frames = ffmpeg.duration * ffmpeg.framerate
+    result['encode_fps'] = frames / result['timings']['encode_seconds']
+
+    started = time.monotonic()
+    ffmpeg.make_subtitles()
+    ffmpeg.make_thumbnails()
+    ffmpeg.make_poster()
+    result['timings']['extras_seconds'] = time.monotonic() - started
+
+    # Packaging on its own first, the upload is measured separately below
+    started = time.monotonic()
+    tasks.transcode_video(video, None)
+    result['timings']['package_seconds'] = time.monotonic() - started
+    result['status'] = video.status
+
+    result['ladders'] = {stats.ladder: {'renditions': stats.renditions, 'bytes': stats.encoded_size, 'seconds': stats.encoding_time}
+        for stats in db_session.query(models.LadderStats).filter_by(video_id=video.id).all()}
+    result['output_bytes'] = dir_size(outdir)
+
+    if mock is not None or args.s3 == 'minio':
+        tasks.celery.conf['STORAGE_BACKEND'] = 'S3'
+        files = [os.path.join(outdir, f) for f in sorted(os.listdir(outdir)) if os.path.isfile(os.path.join(outdir, f))]
+        result['upload'] = tasks.get_transfer_engine().upload(files)
+
+    # Every rung encoded on its own, the ladder pass only tells how long all
+    # of them take together.
+    result['rungs'] = []
+    if args.rungs:
+        rungdir = tempfile.mkdtemp(prefix='watchtogether-bench-')
+        try:
+            for output in ffmpeg.outputs:
+                outfile = os.path.join(rungdir, output['filename'])
+                command = ['ffmpeg', '-y', '-nostdin', '-i', ffmpeg.orig_file] + output['command'] + [outfile]
+
+                started = time.monotonic()
+                subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+                seconds = time.monotonic() - started
+
+                rung = {'filename': output['filename'], 'track_type': output['track_type'], 'ladder': output['ladder'],
+                    'seconds': seconds, 'bytes': os.path.getsize(outfile)}
+                if output['track_type'] == 'video':
+                    rung['fps'] = frames / seconds
+                result['rungs'].append(rung)
+                os.unlink(outfile)
+        finally:
+            shutil.rmtree(rungdir, ignore_errors=True)
+
+    result['peak_rss'] = peak_rss()
+
+    if mock:
+        mock.stop()
+
+    print(json.dumps(result))
+
+def ffmpeg_version():
+    try:
+        output = subprocess.run(['ffmpeg', '-version'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+        return output.splitlines()[0]
+    except (OSError, IndexError):
+        return None
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def run_benchmark(args):
+    cases = [parse_case(name) for name in (args.cases or default_cases)]
+
+    if args.s3 == 'moto':
+        try:
+            import moto
+        except ModuleNotFoundError:
+            print('moto is not installed, install it or use --s3 minio or --s3 none')
+            sys.exit(1)
+    report = {
+        'revision': git_revision(),
+        'host': socket.gethostname(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'python': platform.python_version(),
+        'ffmpeg': ffmpeg_version(),
+        's3': args.s3,
+        'cases': {},
+    }
+
+    for case in cases:
+        source = generate_source(case, args.cache_dir)
+        workdir = tempfile.mkdtemp(prefix='watchtogether-bench-')
+
+        command = [sys.executable, '-m', 'watchtogether.bench.transcode', '--run-case', case['name'], '--source', source, '--s3', args.s3]
+        if args.rungs:
+            command.append('--rungs')
+
+        print(f'Running {case["name"]}')
+        try:
+            ret = subprocess.run(command, env=case_environment(args, workdir, case), stdout=subprocess.PIPE, universal_newlines=True)
+            lines = ret.stdout.strip().splitlines()
+            if ret.returncode != 0 or not lines:
+                print(ret.stdout)
+                report['cases'][case['name']] = {'case': case, 'status': 'failed'}
+                continue
+
+            report['cases'][case['name']] = json.loads(lines[-1])
+        finally:
+            if not args.keep:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+        print(f'Report written to {args.output}')
+    else:
+        print(output)
+
+def compare(before, after):
+    with open(before) as f:
+        before = json.load(f)
+    with open(after) as f:
+        after = json.load(f)
+
+    def change(old, new, lower_is_better=True):
+        if not old or new is None:
+            return 'n/a'
+        percentage = (new - old) / old * 100
+        better = percentage < 0 if lower_is_better else percentage > 0
+        return f'{percentage:+6.1f}%{" better" if better and abs(percentage) >= 1 else ""}'
+
+    print(f'{before.get("revision")} -> {after.get("revision")}')
+    for name in sorted(set(before['cases']) & set(after['cases'])):
+        old = before['cases'][name]
+        new = after['cases'][name]
+        if old.get('status') == 'failed' or new.get('status') == 'failed':
+            print(f'{name}: failed')
+            continue
+
+        print(f'{name}:')
+        print(f'  encode fps    {new["encode_fps"]:10.1f}  {change(old["encode_fps"], new["encode_fps"], False)}')
+        for key in ['encode_seconds', 'extras_seconds', 'package_seconds']:
+            print(f'  {key:14}{new["timings"][key]:9.2f}s  {change(old["timings"][key], new["timings"][key])}')
+        print(f'  output bytes {new["output_bytes"]:11}  {change(old["output_bytes"], new["output_bytes"])}')
+        print(f'  ffmpeg rss   {new["peak_rss"]["children_kib"]:9} KiB  {change(old["peak_rss"]["children_kib"], new["peak_rss"]["children_kib"])}')
+        if 'upload' in old and 'upload' in new:
+            print(f'  upload MiB/s  {new["upload"]["throughput"] / 1048576:10.1f}  {change(old["upload"]["throughput"], new["upload"]["throughput"], False)}')
+
+        old_rungs = {rung['filename']: rung for rung in old.get('rungs', [])}
+        for rung in new.get('rungs', []):
+            if 'fps' in rung and rung['filename'] in old_rungs:
+                print(f'  {rung["filename"]:30} {rung["fps"]:8.1f} fps  {change(old_rungs[rung["filename"]]["fps"], rung["fps"], False)}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the transcode pipeline on synthetic sources')
+    parser.add_argument('cases', nargs='*', help=f'cases to run, like 720p30-stereo-30s (default: {" ".join(default_cases)})')
+    parser.add_argument('-o', '--output', help='write the JSON report here instead of to stdout')
+    parser.add_argument('--cache-dir', default=os.path.join(tempfile.gettempdir(), 'watchtogether-bench-sources'), help='where generated sources are kept')
+    parser.add_argument('--s3', choices=['moto', 'minio', 'none'], default='moto', help='S3 stand-in to measure uploads against')
+    parser.add_argument('--s3-endpoint', default='http://127.0.0.1:9000', help='MinIO endpoint for --s3 minio')
+    parser.add_argument('--rungs', action='store_true', help='also encode every rung on its own to report its fps, takes about twice as long')
+    parser.add_argument('--keep', action='store_true', help='keep the work directories around')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two reports')
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    parser.add_argument('--source', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    elif args.run_case:
+        run_case(args)
+    else:
+        run_benchmark(args)
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
-from sqlalchemy import Table, Column, Integer, String, ForeignKey, Text, DateTime, Boolean, LargeBinary, Float
+from sqlalchemy import Table, Column, Integer, BigInteger, String, ForeignKey, Text, DateTime, Boolean, LargeBinary, Float
 from sqlalchemy_utils.types.password import PasswordType
 from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy.orm import relationship, backref, foreign
+from sqlalchemy.orm import relationship, backref, foreign, deferred
 
 from watchtogether.util import random_string
 from . import Base
@@ -16,7 +16,11 @@ class WatchtogetherBase(object):
     creation_date = Column(DateTime, nullable=False, default=datetime.utcnow)
     title = Column(Text, nullable=False)
     owner = Column(String(15), nullable = False)
-    poster = Column(LargeBinary)
+
+    # Only loaded when asked for, listing or joining never needs it
+    @declared_attr
+    def poster(cls):
+        return deferred(Column(LargeBinary))
 
 class Subtitle(Base):
     __tablename__ = 'subtitle'
@@ -32,6 +36,8 @@ class Subtitle(Base):
     internal_include = Column(Boolean, default=False)
 
     orig_file = Column(Text)    
+    encoded_file = Column(Text)
+    encoding_hash = Column(String(64), index=True)
 
 class EncodedFile(Base):
     __tablename__ = 'encoded_file'
@@ -44,6 +50,34 @@ class EncodedFile(Base):
     encoding_hash = Column(String(64), nullable=False)
     encoded_file_name = Column(Text, nullable=False)
 
+class EncodingUnit(Base):
+    __tablename__ = 'encoding_unit'
+
+    id = Column(Integer, primary_key=True)
+    video_id = Column(String(10), ForeignKey('video.id'), nullable=False)
+
+    track_type = Column(String(10), nullable=False)
+    ladder = Column(String(10), nullable=False, default='h264')
+    encoded_file_name = Column(Text)
+    start = Column(Float, nullable=False, default=0)
+    end = Column(Float, nullable=False, default=0)
+    encoding_progress = Column(Float, default=0)
+    encoding_speed = Column(Float, default=0)
+    encoding_time = Column(Float)
+    encoding_hash = Column(String(64))
+    done = Column(Boolean, nullable=False, default=False)
+
+class LadderStats(Base):
+    __tablename__ = 'ladder_stats'
+
+    id = Column(Integer, primary_key=True)
+    video_id = Column(String(10), ForeignKey('video.id'), nullable=False)
+
+    ladder = Column(String(10), nullable=False)
+    renditions = Column(Integer, nullable=False, default=0)
+    encoded_size = Column(BigInteger, nullable=False, default=0)
+    encoding_time = Column(Float)
+
 class Video(WatchtogetherBase, Base):
     __tablename__ = 'video'
     
@@ -57,6 +91,7 @@ class Video(WatchtogetherBase, Base):
     duration = Column(Float, nullable=False, default=0)
 
     upload_identifier = Column(Text)
+    content_hash = Column(String(64), index=True)
 
     tune = Column(String(15), nullable=False, default='film')
     default_subtitles = Column(Boolean, default=False)
@@ -64,8 +99,13 @@ class Video(WatchtogetherBase, Base):
     orig_file = Column(Text)
     orig_file_name = Column(Text)
     playlist = Column(Text)
+    watchable = Column(Boolean, nullable=False, default=False)
+    thumbnails = Column(Text)
+    poster_file = Column(Text)
 
     celery_taskid = Column(Text)
 
     subtitles = relationship('Subtitle', backref='Video', lazy=True)
     encoded_files = relationship('EncodedFile', backref='Video', lazy=True)
+    encoding_units = relationship('EncodingUnit', backref='Video', lazy=True)
+    ladder_stats = relationship('LadderStats', backref='Video', lazy=True)
@@ -16,20 +16,18 @@ def on_connect():
 @socketio.on('join')
 def on_join(data):
     print(f"Client logged on, username:{data['username']}, room:{data['room']}")
-    if data['room'] not in rooms.keys():
-        video = db_session.query(models.Video).filter_by(id=data['room']).one_or_none()
-        rooms[data['room']] = Room(data['room'], video)
-
     roomname = data['room']
-    room = rooms[roomname]
+    room = Room.get(roomname)
+    if not room:
+        return
 
     username = html.escape(data['username'])
 
     new_user = room.join(request.sid, username)
     join_room(roomname)
-    timer = rooms[roomname].timer
+    position, running = room.timer.state()
 
-    emit('connected', {'time': timer.get(), 'state': timer.running, 'username': room.last })
+    emit('connected', {'time': position, 'state': running, 'username': room.last })
     if new_user:
       emit('joined', {'username': username}, room=roomname, include_self=False)
 
@@ -37,27 +35,26 @@ def on_join(data):
 def on_disconnect():
     print("Client disconnected")
 
-    for name, room in rooms.items():
-        if room.has_sid(request.sid):
-            username = room.get_user_by_sid(request.sid)
-            if room.leave(request.sid):
-                emit('left', {'username': username}, room=room.name)
+    for room in Room.rooms_for_sid(request.sid):
+        username = room.get_user_by_sid(request.sid)
+        if room.leave(request.sid):
+            emit('left', {'username': username}, room=room.name)
         
 @socketio.on('time_get')
 def on_time_get(data):
     roomname = data['room']
-    room = rooms[roomname]
-    timer = rooms[roomname].timer
+    room = Room.get(roomname)
+    position, running = room.timer.state()
 
-    print(f"Time_get: {timer.get()}, {timer.running}, {data['stamp']}")
-    emit('time_get', {'time': timer.get(), 'state': timer.running, 'stamp': data['stamp']});
+    print(f"Time_get: {position}, {running}, {data['stamp']}")
+    emit('time_get', {'time': position, 'state': running, 'stamp': data['stamp']});
 
 @socketio.on('time_start')
 def on_time_start(data):
     print("Start")
     roomname = data['room']
-    room = rooms[roomname]
-    timer = rooms[roomname].timer
+    room = Room.get(roomname)
+    timer = room.timer
     username = room.get_user_by_sid(request.sid)
 
     timer.start()
@@ -69,8 +66,8 @@ def on_time_start(data):
 def on_time_pause(data):
     print("Pause")
     roomname = data['room']
-    room = rooms[roomname]
-    timer = rooms[roomname].timer
+    room = Room.get(roomname)
+    timer = room.timer
     username = room.get_user_by_sid(request.sid)
 
     timer.pause()
@@ -82,8 +79,8 @@ def on_time_pause(data):
 def on_time_reset(data):
     print("Reset")
     roomname = data['room']
-    room = rooms[roomname]
-    timer = rooms[roomname].timer
+    room = Room.get(roomname)
+    timer = room.timer
     username = room.get_user_by_sid(request.sid)
 
     timer.reset()
@@ -104,8 +101,8 @@ def on_time_set(data):
     print(f"Time_set: {time}")
 
     roomname = data['room']
-    room = rooms[roomname]
-    timer = rooms[roomname].timer
+    room = Room.get(roomname)
+    timer = room.timer
     username = room.get_user_by_sid(request.sid)
 
     timer.set(time)
@@ -116,8 +113,7 @@ def on_time_set(data):
 @socketio.on('message')
 def on_message(data):
     roomname = data['room']
-    room = rooms[roomname]
-    timer = rooms[roomname].timer
+    room = Room.get(roomname)
     username = room.get_user_by_sid(request.sid)
 
     print(f"message: {username}: {data['text']}");
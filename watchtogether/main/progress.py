@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+import json
+
+import redis
+from flask import request
+from flask import current_app as app
+from flask_socketio import join_room
+
+from watchtogether import socketio
+from watchtogether.config import settings
+from watchtogether.database import models, db_session
+
+relay = None
+
+def relay_progress():
+    while True:
+        try:
+            pubsub = redis.Redis.from_url(settings.REDIS_URL).pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(settings.PROGRESS_CHANNEL)
+
+            for message in pubsub.listen():
+                data = json.loads(message['data'])
+                socketio.emit('progress', data, room=data['id'], namespace='/progress')
+        except redis.exceptions.RedisError as e:
+            print(f"Progress relay lost connection: {e}")
+            socketio.sleep(5)
+
+@socketio.on('join', namespace='/progress')
+def on_progress_join(data):
+    global relay
+
+    owner_id = request.cookies.get(app.config['COOKIE_OWNER_ID'])
+    video = db_session.query(models.Video).filter_by(owner=owner_id, id=data['video_id']).one_or_none()
+
+    if not video:
+        return
+
+    # Workers emit onto the message queue themselves when there is one
+    if not relay and not settings.SOCKETIO_MESSAGE_QUEUE:
+        relay = socketio.start_background_task(relay_progress)
+
+    join_room(video.id)
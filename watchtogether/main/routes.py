@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
 
+import os
 import json
 
-from flask import Flask, render_template, request, make_response, redirect, abort
+from flask import Flask, render_template, request, make_response, redirect, abort, send_from_directory, url_for
 from flask import current_app as app
 
-from watchtogether import rooms, tasks
+from watchtogether import Room, tasks
 from watchtogether.database import models, db_session
 from watchtogether.auth import ownerid
 
@@ -43,8 +44,25 @@ def watch(video_id):
         baseurl = app.config['S3_BUCKET_URL']
         if not baseurl.endswith("/"):
             baseurl = baseurl + "/"
+
+    poster_url = None
+    if video.poster_file:
+        poster_url = baseurl + video.poster_file
+        if app.config['STORAGE_BACKEND'] != 'S3':
+            poster_url = url_for('main.poster', video_id=video.id, filename=os.path.basename(video.poster_file))
     
-    return render_template("watch.html", baseurl = baseurl, video = video)
+    return render_template("watch.html", baseurl = baseurl, video = video, poster_url = poster_url)
+
+@main.route("/posters/<video_id>/<filename>", methods=["GET"])
+def poster(video_id, filename):
+    video = db_session.query(models.Video).filter_by(id=video_id).one_or_none()
+
+    if not video or video.poster_file != f'{video_id}/{filename}':
+        abort(404, "Poster not found")
+
+    # Poster names change along with their content, so they never go stale
+    directory = os.path.abspath(os.path.join(app.config['MOVIE_PATH'], video_id))
+    return send_from_directory(directory, filename, mimetype='image/jpeg', cache_timeout=app.config['POSTER_MAX_AGE'])
 
 @main.route("/chat/<video_id>", methods=["GET"])
 @ownerid
@@ -59,10 +77,18 @@ def chat(video_id):
 @main.route("/messages/<room>", methods=["GET"])
 @ownerid
 def get_messages(room):
-    return "".join(rooms[room].get_messages())
+    room = Room.get(room)
+    if not room:
+        abort(404, "Room not found")
+
+    return "".join(room.get_messages())
 
 @main.route("/users/<room>", methods=["GET"])
 @ownerid
 def get_users(room):
-    return json.dumps(rooms[room].get_users())
+    room = Room.get(room)
+    if not room:
+        abort(404, "Room not found")
+
+    return json.dumps(room.get_users())
 
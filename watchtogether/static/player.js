@@ -15,6 +15,7 @@ class VideoPlayer {
 
     this.hls = null;
     this.dash = null;
+    this.thumbnails = [];
 
     this.setup_dom();
 
@@ -54,6 +55,8 @@ class VideoPlayer {
     this.settings_button.addEventListener("click", this.on_settings_click.bind(this));
 
     this.timeline.addEventListener("change", this.on_seek.bind(this));
+    this.timeline.addEventListener("mousemove", this.on_timeline_hover.bind(this));
+    this.timeline.addEventListener("mouseleave", this.hide_thumbnail.bind(this));
     this.timeline.disabled = true;
 
     this.videotime_label.innerHTML = this.seconds_to_timestring(0);
@@ -135,6 +138,9 @@ class VideoPlayer {
     this.timeline.disabled = true;
     this.timeline_bar.appendChild(this.timeline);
 
+    this.thumbnail = this.create_element('div', ['thumbnail', 'hidden']);
+    this.timeline_bar.appendChild(this.thumbnail);
+
     this.videoduration_label = this.create_element('span', ['time-label', 'video-duration']);
     this.timeline_bar.appendChild(this.videoduration_label);
 
@@ -146,6 +152,9 @@ class VideoPlayer {
       this.set_dash_stream(url);
     } else if (url.endsWith(".m3u8")) {
       this.set_hls_stream(url);
+    } else if (url.endsWith(".mp4")) {
+      console.log("player: playing file directly");
+      this.video.src = url;
     } else {
       console.log("Uknown URL type, player not initializing");
     }
@@ -228,6 +237,84 @@ class VideoPlayer {
     }
   }
 
+  set_thumbnails(url) {
+    // Seek previews come from sprite sheets listed in a WebVTT file, so
+    // hovering over the timeline never has to touch the video segments.
+    fetch(url).then(function(response) {
+      if (! response.ok) {
+        throw new Error("HTTP " + response.status);
+      }
+      return response.text();
+    }).then(function(text) {
+      this.thumbnails = this.parse_thumbnails(url, text);
+    }.bind(this)).catch(function(error) {
+      console.log("player: loading thumbnails failed: " + error);
+    });
+  }
+
+  parse_thumbnails(url, text) {
+    var thumbnails = [];
+    var blocks = text.split(/\r?\n\r?\n/);
+
+    for (var i = 0; i < blocks.length; i++) {
+      var lines = blocks[i].trim().split(/\r?\n/);
+      var timing = lines.findIndex(function(line) { return line.includes("-->"); });
+      if (timing == -1 || timing + 1 >= lines.length) {
+        continue;
+      }
+
+      var times = lines[timing].split("-->");
+      var target = lines[timing + 1].split("#xywh=");
+      if (target.length != 2) {
+        continue;
+      }
+
+      var xywh = target[1].split(",").map(Number);
+      thumbnails.push({
+        'start': this.timestring_to_seconds(times[0]),
+        'end': this.timestring_to_seconds(times[1]),
+        'url': new URL(target[0], new URL(url, document.baseURI)).href,
+        'x': xywh[0],
+        'y': xywh[1],
+        'width': xywh[2],
+        'height': xywh[3]
+      });
+    }
+
+    return thumbnails;
+  }
+
+  timestring_to_seconds(timestring) {
+    var parts = timestring.trim().split(":").map(parseFloat);
+    var seconds = 0;
+
+    for (var i = 0; i < parts.length; i++) {
+      seconds = seconds * 60 + parts[i];
+    }
+
+    return seconds;
+  }
+
+  show_thumbnail(time, position) {
+    var thumbnail = this.thumbnails.find(function(t) { return time >= t.start && time < t.end; });
+    if (! thumbnail) {
+      this.hide_thumbnail();
+      return;
+    }
+
+    this.thumbnail.style.width = thumbnail.width + "px";
+    this.thumbnail.style.height = thumbnail.height + "px";
+    this.thumbnail.style.backgroundImage = "url('" + thumbnail.url + "')";
+    this.thumbnail.style.backgroundPosition = "-" + thumbnail.x + "px -" + thumbnail.y + "px";
+    this.thumbnail.style.left = (position - thumbnail.width / 2) + "px";
+    this.thumbnail.style.top = (-thumbnail.height - 10) + "px";
+    this.thumbnail.classList.remove("hidden");
+  }
+
+  hide_thumbnail() {
+    this.thumbnail.classList.add("hidden");
+  }
+
   seconds_to_timestring(sec) {
     var hours = new String(Math.floor(sec / 3600).toFixed());
     sec %= 3600;
@@ -429,6 +516,10 @@ class VideoPlayer {
     this.loader.classList.remove('loading');
   }
 
+  set_poster(url) {
+    this.poster.style.backgroundImage = "url('" + url + "')";
+  }
+
   show_poster() {
     this.poster.classList.remove('hidden');
   }
@@ -532,6 +623,18 @@ class VideoPlayer {
     this.dispatchEvent(new CustomEvent('seek-clicked', {detail:{'time': time}}));
   }
 
+  on_timeline_hover(event) {
+    if (! this.thumbnails.length || ! this.video.duration) {
+      return;
+    }
+
+    var rect = this.timeline.getBoundingClientRect();
+    var bar = this.timeline_bar.getBoundingClientRect();
+    var fraction = Math.min(Math.max((event.clientX - rect.left) / rect.width, 0), 1);
+
+    this.show_thumbnail(fraction * this.video.duration, event.clientX - bar.left);
+  }
+
   on_timeupdate() {
     this.timeline.value = this.video.currentTime;
     this.videotime_label.innerHTML = this.seconds_to_timestring(this.video.currentTime);
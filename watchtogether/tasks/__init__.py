@@ -1,113 +1,583 @@
 #!/usr/bin/env python3
 
 import os
+import re
+import math
 import glob
 import json
 import time
 import shutil
 import socket
 import hashlib
+import secrets
 import tempfile
 import threading
 import subprocess
+from xml.sax.saxutils import escape, quoteattr
 
-import numpy 
-import boto3
-import boto3.session
-from botocore.exceptions import NoCredentialsError
+import redis
 
-from celery import Celery, states
+from celery import Celery, states, chord
 from celery.exceptions import Ignore
 from celery.signals import worker_ready
 import billiard as multiprocessing
+from flask_socketio import SocketIO
 
 from watchtogether.database import models, db_session, init_engine
 from watchtogether.config import settings
-from watchtogether.util import rm_f, ffprobe
+from watchtogether.util import rm_f, unlink_tree, link_or_copy, upload_key, ffprobe, get_keyframes, index_first, probe_key
 
-celery = Celery(__name__, broker=settings.CELERY_BROKER_URL)
+from .transfer import TransferEngine, object_key
+from .ladder import LadderAnalysis, kbit
+
+celery = Celery(__name__, broker=settings.CELERY_BROKER_URL, backend=settings.CELERY_RESULT_BACKEND)
 celery.conf.update(settings.as_dict())
 init_engine(settings.SQLALCHEMY_DATABASE_URI)
+dash_size = 4
+worker_redis = redis.Redis.from_url(settings.REDIS_URL)
+progress_socketio = SocketIO(message_queue=settings.SOCKETIO_MESSAGE_QUEUE) if settings.SOCKETIO_MESSAGE_QUEUE else None
+
+def requeue_orphaned_encodes():
+    # Every worker runs this when it starts, only videos nobody holds a lease
+    # for anymore are queued again and only by whoever gets the new lease.
+    videos = db_session.query(models.Video).filter(models.Video.status.in_(['encoding', 'start-encoding'])).all()
+    for video in videos:
+        if VideoLease.held(video.id):
+            continue
+
+        if queue_transcode(video.id):
+            print(f'Requeued orphaned encode of {video.id}')
 
 @worker_ready.connect
 def on_worker_ready(**kwargs):
-    encoding_videos = db_session.query(models.Video).filter_by(status='encoding').all()
-    for video in encoding_videos:
-        transcode.delay(video.id)
-
-    start_encoding_videos = db_session.query(models.Video).filter_by(status='start-encoding').all()
-    for video in start_encoding_videos:
-        transcode.delay(video.id)
-
-def s3_upload(files):
-    params = {
-        'aws_access_key_id': celery.conf.get('S3_ACCESS_KEY'),
-        'aws_secret_access_key': celery.conf.get('S3_SECRET_KEY'),
+    requeue_orphaned_encodes()
+
+def publish_progress(video):
+    message = {
+        'id': video.id,
+        'status': video.status,
+        'watchable': video.watchable,
+        'encoding_progress': video.encoding_progress,
+        'encoding_speed': video.encoding_speed,
     }
 
-    if celery.conf.get('S3_ENDPOINT_URL'):
-        params['endpoint_url'] = celery.conf.get('S3_ENDPOINT_URL')
+    try:
+        # With a message queue the app processes share, emitting onto it
+        # reaches the right clients whichever process holds them.
+        if progress_socketio:
+            progress_socketio.emit('progress', message, room=video.id, namespace='/progress')
+        else:
+            worker_redis.publish(celery.conf.get('PROGRESS_CHANNEL'), json.dumps(message))
+    except redis.exceptions.RedisError as e:
+        print(f'Publishing progress failed: {e}')
+
+transfer_engine = None
+
+def get_transfer_engine():
+    global transfer_engine
 
-    if celery.conf.get('S3_REGION'):
-        params['region_name'] = celery.conf.get('S3_REGION')
+    if not transfer_engine:
+        transfer_engine = TransferEngine(celery.conf)
 
-    session = boto3.session.Session()
-    s3 = session.resource('s3', **params)
-    bucket = s3.Bucket(celery.conf.get('S3_BUCKET'))
+    return transfer_engine
+
+class OutputUploader(threading.Thread):
+    def __init__(self, outdir):
+        super().__init__(daemon=True)
+        self.outdir = outdir
+        self.manifest = f'{outdir}/playlist.mpd'
+        self.interval = celery.conf.get('S3_UPLOAD_INTERVAL')
+        self.stopping = threading.Event()
+        self.seen = {}
+        self.uploaded = {}
+        self.remote = None
+
+    def changed_files(self):
+        changed = {}
+        for f in glob.glob(f'{self.outdir}/*'):
+            if f == self.manifest or f.endswith('.tmp'):
+                continue
 
-    for f in files:
-        tries = 0
-        while tries < 10:
             try:
-                bucket.upload_file(f, "/".join(f.split("/")[-2:]), ExtraArgs={'ACL': 'public-read'})
-                break
-            except:
-                tries = tries + 1
+                st = os.stat(f)
+            except FileNotFoundError:
+                continue
+
+            state = (st.st_size, st.st_mtime_ns)
+            if os.path.isfile(f) and self.uploaded.get(f) != state:
+                changed[f] = state
+
+        return changed
+
+    def upload(self, files):
+        engine = get_transfer_engine()
+
+        # The bucket is only listed once, from then on what went up is known
+        # from the size and mtime of every file when it was uploaded.
+        if self.remote is None:
+            self.remote = engine.list_prefix(object_key(self.manifest).rsplit('/', 1)[0] + '/')
+
+        stats = engine.upload(list(files.keys()), self.remote)
+        failed = set(stats['failed_keys'])
+        for f, state in files.items():
+            if object_key(f) not in failed:
+                self.uploaded[f] = state
+                self.remote.pop(object_key(f), None)
+
+        return stats
+
+    def poll(self):
+        # A file is considered final once it hasn't changed for a whole
+        # interval, the encoder or packager has moved on to the next one by then.
+        changed = self.changed_files()
+        final = {f: state for f, state in changed.items() if self.seen.get(f) == state}
+        self.seen = changed
+
+        if final:
+            print(f"Uploading {len(final)} finished files to S3")
+            self.upload(final)
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.poll()
+
+    def stop(self):
+        self.stopping.set()
+        if self.is_alive():
+            self.join()
+
+    def finish(self, manifest=True):
+        self.stop()
+        if self.upload(self.changed_files())['failed']:
+            return False
+
+        # The manifest goes up last so it never points at missing files
+        if manifest and os.path.exists(self.manifest):
+            return not get_transfer_engine().upload([self.manifest], self.remote)['failed']
+
+        return True
+
+def start_uploader(outdir):
+    if celery.conf.get('STORAGE_BACKEND') != "S3":
+        return None
+
+    uploader = OutputUploader(outdir)
+    uploader.start()
+    return uploader
+
+def upload_pending(video):
+    # The chunk bitmap outlives an upload for a while, an upload is only still
+    # going if it has one but was never marked complete.
+    if not video.upload_identifier:
+        return False
+
+    key = upload_key(video.id, video.upload_identifier)
+    return bool(worker_redis.exists(key)) and not worker_redis.exists(f'{key}:complete')
+
+class VideoLease:
+    # Whoever holds the lease of a video is the only one encoding it. A
+    # running job renews it from a thread of its own, so a lease that ran out
+    # means the job died. One that ran out while its job was still queued is
+    # taken by whoever queues the video again, the older job then gives way.
+    renew_script = """
+        local holder = redis.call('get', KEYS[1])
+        if holder == ARGV[1] then
+            return redis.call('expire', KEYS[1], ARGV[2])
+        elseif not holder and ARGV[3] == '1' then
+            return redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[2]) and 1 or 0
+        end
+        return 0
+    """
+
+    release_script = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            return redis.call('del', KEYS[1])
+        end
+        return 0
+    """
+
+    def __init__(self, video_id, token=None):
+        self.key = VideoLease.lease_key(video_id)
+        self.token = token or secrets.token_hex(16)
+        self.ttl = celery.conf.get('LEASE_TTL')
+        self.stopping = threading.Event()
+        self.heartbeat = None
+        self.lost = False
+
+    @staticmethod
+    def lease_key(video_id):
+        return f'transcode-lease:{video_id}'
+
+    @staticmethod
+    def held(video_id):
+        return bool(worker_redis.exists(VideoLease.lease_key(video_id)))
+
+    def acquire(self):
+        return bool(worker_redis.set(self.key, self.token, nx=True, ex=self.ttl))
+
+    def renew(self, retake=True):
+        # A job that starts may take its lease back if it ran out while the
+        # job was queued. A running one only keeps what it holds, a released
+        # lease stops every task that shares it.
+        try:
+            return bool(worker_redis.eval(self.renew_script, 1, self.key, self.token, self.ttl, 1 if retake else 0))
+        except redis.exceptions.RedisError as e:
+            # Nobody can tell who holds it, so nobody does
+            print(f'Renewing lease failed: {e}')
+            return False
+
+    def keep_renewed(self):
+        while not self.stopping.wait(self.ttl / 3):
+            if not self.renew(retake=False):
+                print(f'Lost lease {self.key}')
+                self.lost = True
+                return
+
+    def hold(self):
+        # Packaging, uploads and merges don't report progress, the lease
+        # is renewed in the background for every phase of the job.
+        self.heartbeat = threading.Thread(target=self.keep_renewed, daemon=True)
+        self.heartbeat.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.heartbeat and self.heartbeat.is_alive():
+            self.heartbeat.join()
+
+    def release(self):
+        self.stop()
+        try:
+            worker_redis.eval(self.release_script, 1, self.key, self.token)
+        except redis.exceptions.RedisError as e:
+            print(f'Releasing lease failed: {e}')
+
+def queue_transcode(video_id):
+    # Refuses to queue a video that a queued or running job already holds
+    lease = VideoLease(video_id)
+    if not lease.acquire():
+        return None
+
+    return transcode.delay(video_id, lease.token)
+
+class UploadFollower(threading.Thread):
+    # Feeds a file that is still being uploaded to ffmpeg through a fifo,
+    # never reading past the chunks that have arrived without a gap.
+    def __init__(self, video, filename, fifo):
+        super().__init__(daemon=True)
+        self.key = upload_key(video.id, video.upload_identifier)
+        self.filename = filename
+        self.fifo = fifo
+        self.size = os.path.getsize(filename)
+        self.chunk_size = celery.conf.get('UPLOAD_CHUNK_SIZE')
+        self.total_chunks = max(self.size // self.chunk_size, 1)
+        self.timeout = celery.conf.get('UPLOAD_FOLLOW_TIMEOUT')
+        self.stopping = threading.Event()
+        self.sent = 0
+
+    @property
+    def complete(self):
+        return self.sent == self.size
+
+    def available(self):
+        if worker_redis.exists(f'{self.key}:complete'):
+            return self.size
+
+        # resumable.js gives the remainder of the file to the last chunk
+        first_missing = worker_redis.bitpos(self.key, 0)
+        if first_missing >= self.total_chunks:
+            return self.size
+
+        return first_missing * self.chunk_size
+
+    def run(self):
+        last_data = time.time()
+
+        try:
+            with open(self.fifo, 'wb') as out, open(self.filename, 'rb') as f:
+                while not self.complete and not self.stopping.is_set():
+                    available = self.available()
+                    if available <= self.sent:
+                        if time.time() - last_data > self.timeout:
+                            print(f'Upload of {self.filename} stalled, giving up')
+                            break
+
+                        self.stopping.wait(1)
+                        continue
+
+                    f.seek(self.sent)
+                    while self.sent < available:
+                        block = f.read(min(1024 * 1024, available - self.sent))
+                        if not block:
+                            break
+
+                        out.write(block)
+                        self.sent = self.sent + len(block)
+
+                    last_data = time.time()
+        except (OSError, redis.exceptions.RedisError) as e:
+            print(f'Following upload of {self.filename} failed: {e}')
+
+    def stop(self):
+        self.stopping.set()
+
+        # If ffmpeg never opened the fifo the writer is still waiting for a
+        # reader, open and close the other end to let it go.
+        try:
+            os.close(os.open(self.fifo, os.O_RDONLY | os.O_NONBLOCK))
+        except OSError:
+            pass
+
+        if self.is_alive():
+            self.join()
 
 @celery.task
 def s3_delete(video_id):
-    params = {
-        'aws_access_key_id': celery.conf.get('S3_ACCESS_KEY'),
-        'aws_secret_access_key': celery.conf.get('S3_SECRET_KEY'),
-    }
+    get_transfer_engine().delete_prefix(f"{video_id}/")
+
+@celery.on_after_configure.connect
+def setup_periodic_tasks(sender, **kwargs):
+    sender.add_periodic_task(settings.GC_INTERVAL, collect_garbage.s())
+
+@celery.task
+def delete_video(video_id):
+    movie_path = celery.conf.get('MOVIE_PATH')
+    rate = celery.conf.get('GC_UNLINK_RATE')
+
+    for f in glob.glob(f'{movie_path}/{video_id}_*'):
+        rm_f(f)
 
-    if celery.conf.get('S3_ENDPOINT_URL'):
-        params['endpoint_url'] = celery.conf.get('S3_ENDPOINT_URL')
+    unlink_tree(f'{movie_path}/{video_id}', rate)
 
-    if celery.conf.get('S3_REGION'):
-        params['region_name'] = celery.conf.get('S3_REGION')
+    if celery.conf.get('STORAGE_BACKEND') == 'S3':
+        get_transfer_engine().delete_prefix(f"{video_id}/", rate)
 
-    session = boto3.session.Session()
-    s3 = session.resource('s3', **params)
-    bucket = s3.Bucket(celery.conf.get('S3_BUCKET'))
-    bucket.objects.filter(Prefix=f"{video_id}/").delete()
+@celery.task
+def collect_garbage():
+    movie_path = celery.conf.get('MOVIE_PATH')
+    rate = celery.conf.get('GC_UNLINK_RATE')
+    min_age = celery.conf.get('GC_MIN_AGE')
+    now = time.time()
+
+    def old(path, age=min_age):
+        try:
+            return now - os.lstat(path).st_mtime > age
+        except FileNotFoundError:
+            return False
+
+    # List the files before asking the database, anything created in between
+    # is too new to be considered anyway.
+    entries = os.listdir(movie_path)
+    videos = {video.id: video for video in db_session.query(models.Video).all()}
+    busy = ['start-encoding', 'encoding']
+
+    for entry in entries:
+        match = re.match(r'^([A-Z0-9]{10})(_.*)?$', entry)
+        if not match:
+            continue
+
+        path = os.path.join(movie_path, entry)
+        video = videos.get(match.group(1))
+
+        if not video:
+            if old(path):
+                print(f'GC: removing orphaned {path}')
+                unlink_tree(path, rate)
+            continue
+
+        if video.status in busy:
+            continue
+
+        if entry.endswith('.log') and old(path):
+            print(f'GC: removing encoder log {path}')
+            rm_f(path)
+
+        if os.path.isdir(path) and os.path.exists(f'{path}/.units') and old(f'{path}/.units'):
+            print(f'GC: removing leftover encoding units in {path}')
+            unlink_tree(f'{path}/.units', rate)
+
+        # Provisional encodes are only kept around for rooms that started
+        # watching before the full ladder was done.
+        fast_files = glob.glob(f'{path}/fast[_.-]*') if os.path.isdir(path) else []
+        if video.status == 'ready' and video.playlist != f'{video.id}/fast.mpd' and fast_files and all(old(f) for f in fast_files):
+            print(f'GC: removing provisional encode in {path}')
+            for f in fast_files:
+                rm_f(f)
+
+            if celery.conf.get('STORAGE_BACKEND') == 'S3':
+                get_transfer_engine().delete_prefix(f'{video.id}/fast', rate)
+
+    for video in videos.values():
+        if video.status != 'file-uploading' or not video.orig_file:
+            continue
+
+        orig_file = os.path.join(movie_path, video.orig_file)
+        if not old(orig_file, celery.conf.get('UPLOAD_ABANDON_AGE')):
+            continue
+
+        print(f'GC: removing abandoned upload {orig_file}')
+        rm_f(orig_file)
+        rm_f(f'{orig_file}.chunks')
+        video.status = 'file-waiting'
+        video.upload_identifier = None
+        video.orig_file = None
+        db_session.commit()
+
+    requeue_orphaned_encodes()
+
+    for tmpdir in glob.glob(os.path.join(tempfile.gettempdir(), 'watchtogether-*')):
+        if old(tmpdir):
+            print(f'GC: removing encoder tmpdir {tmpdir}')
+            unlink_tree(tmpdir, rate)
+
+    if celery.conf.get('STORAGE_BACKEND') == 'S3':
+        engine = get_transfer_engine()
+        directories = engine.list_directories()
+        video_ids = set(video.id for video in db_session.query(models.Video).all())
+
+        for directory in directories:
+            if re.match(r'^[A-Z0-9]{10}$', directory) and directory not in video_ids:
+                print(f'GC: removing orphaned bucket directory {directory}/')
+                engine.delete_prefix(f'{directory}/', rate)
 
 class FfmpegException(Exception):
     pass
 
+text_subtitle_codecs = ['subrip', 'ass', 'ssa', 'mov_text', 'webvtt', 'text']
+
+def add_subtitles(video, manifest):
+    # dash.js loads a whole WebVTT file named in a BaseURL as a text track,
+    # subtitles are far too small to be worth segmenting.
+    subtitles = [s for s in video.subtitles if s.encoded_file and (not s.internal or s.internal_include)]
+
+    with open(manifest) as f:
+        mpd = f.read()
+
+    mpd = re.sub(r'\s*<AdaptationSet[^>]*mimeType="text/vtt".*?</AdaptationSet>', '', mpd, flags=re.DOTALL)
+
+    sets = ''
+    for subtitle in subtitles:
+        sets += f'\n  <AdaptationSet mimeType="text/vtt" contentType="text" lang={quoteattr(subtitle.language or "und")}>'
+        if subtitle.title:
+            sets += f'\n   <Label>{escape(subtitle.title)}</Label>'
+        sets += '\n   <Role schemeIdUri="urn:mpeg:dash:role:2011" value="subtitle"/>'
+        sets += f'\n   <Representation id="subtitle-{subtitle.id}" bandwidth="256">'
+        sets += f'\n    <BaseURL>{escape(os.path.basename(subtitle.encoded_file))}</BaseURL>'
+        sets += '\n   </Representation>\n  </AdaptationSet>'
+
+    mpd = re.sub(r'\s*</Period>', lambda match: f'{sets}\n </Period>', mpd, count=1)
+    with open(f'{manifest}.tmp', 'w') as f:
+        f.write(mpd)
+    os.replace(f'{manifest}.tmp', manifest)
+
+def vtt_timestamp(seconds):
+    seconds, milliseconds = divmod(round(seconds * 1000), 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours:02d}:{minutes:02d}:{seconds:02d}.{milliseconds:03d}'
+
+def stream_options(command, stream_type, index):
+    # Turn the options for a single stream output file into options for the
+    # index'th stream of the given type in a file with many streams.
+    options = []
+    args = iter(command)
+    for arg in args:
+        if arg in ['-an', '-vn', '-sn', '-dn']:
+            continue
+
+        value = next(args)
+        if arg == '-map_chapters':
+            continue
+
+        if arg != '-map':
+            if not arg.endswith(f':{stream_type}'):
+                arg = f'{arg}:{stream_type}'
+            arg = f'{arg}:{index}'
+
+        options.extend([arg, value])
+
+    return options
+
+# Rungs of the optional second ladder, each one is used for the H.264
+# renditions up to its width. The rates are roughly what the codec needs to
+# look as good as H.264 does at the rate of the matching rung.
+extra_ladders = {
+    'hevc': [
+        {'width':  320, 'crf': '26', 'maxrate':  '120k', 'bufsize':  '180k'},
+        {'width':  480, 'crf': '26', 'maxrate':  '240k', 'bufsize':  '300k'},
+        {'width':  640, 'crf': '25', 'maxrate':  '540k', 'bufsize':  '720k'},
+        {'width':  960, 'crf': '25', 'maxrate':  '720k', 'bufsize':  '900k'},
+        {'width': 1280, 'crf': '24', 'maxrate': '1200k', 'bufsize': '2400k'},
+        {'width': 1920, 'crf': '24', 'maxrate': '2700k', 'bufsize': '4800k'},
+    ],
+    'av1': [
+        {'width':  320, 'crf': '38', 'maxrate':  '100k', 'bufsize':  '150k'},
+        {'width':  480, 'crf': '38', 'maxrate':  '200k', 'bufsize':  '250k'},
+        {'width':  640, 'crf': '36', 'maxrate':  '450k', 'bufsize':  '600k'},
+        {'width':  960, 'crf': '36', 'maxrate':  '600k', 'bufsize':  '750k'},
+        {'width': 1280, 'crf': '34', 'maxrate': '1000k', 'bufsize': '2000k'},
+        {'width': 1920, 'crf': '34', 'maxrate': '2250k', 'bufsize': '4000k'},
+    ],
+    'vp9': [
+        {'width':  320, 'crf': '37', 'maxrate':  '130k', 'bufsize':  '200k'},
+        {'width':  480, 'crf': '37', 'maxrate':  '260k', 'bufsize':  '330k'},
+        {'width':  640, 'crf': '35', 'maxrate':  '590k', 'bufsize':  '780k'},
+        {'width':  960, 'crf': '35', 'maxrate':  '780k', 'bufsize':  '980k'},
+        {'width': 1280, 'crf': '33', 'maxrate': '1300k', 'bufsize': '2600k'},
+        {'width': 1920, 'crf': '33', 'maxrate': '2900k', 'bufsize': '5200k'},
+    ],
+}
+
+def extra_ladder_options(ladder, rung, keyint):
+    if ladder == 'hevc':
+        return ['-c:v', 'libx265', '-preset:v', 'medium', '-tag:v', 'hvc1',
+            '-x265-params', f'keyint={keyint}:min-keyint={keyint}:scenecut=0:open-gop=0:log-level=error',
+            '-crf', rung['crf'], '-maxrate', rung['maxrate'], '-bufsize', rung['bufsize']]
+
+    if ladder == 'av1':
+        return ['-c:v', 'libsvtav1', '-preset:v', '8', '-g', f'{keyint}', '-svtav1-params', 'scd=0',
+            '-crf', rung['crf'], '-maxrate', rung['maxrate'], '-bufsize', rung['bufsize']]
+
+    if ladder == 'vp9':
+        return ['-c:v', 'libvpx-vp9', '-deadline', 'good', '-cpu-used', '2', '-row-mt', '1',
+            '-keyint_min', f'{keyint}', '-g', f'{keyint}', '-crf', rung['crf'], '-b:v', rung['maxrate'], '-bufsize', rung['bufsize']]
+
+    raise FfmpegException(f'Unknown ladder {ladder}')
+
 class FfmpegTranscode:
-    def __init__(self, video, task, outdir):
+    def __init__(self, video, task, outdir, lease=None):
         self.video = video
         self.task = task
         self.outdir = outdir
-        self.tmpdir = tempfile.mkdtemp()
+        self.lease = lease
+        self.tmpdir = tempfile.mkdtemp(prefix='watchtogether-')
         self.socketfile = os.path.join(self.tmpdir, 'progress')
         self.orig_file = os.path.join(celery.conf.get('MOVIE_PATH'), video.orig_file)
-        self.streaminfo = ffprobe(self.orig_file)
+        self.following_upload = upload_pending(video)
+        self.input_file = os.path.join(self.tmpdir, 'input') if self.following_upload else self.orig_file
+        self.streaminfo = ffprobe(self.orig_file, cache=not self.following_upload)
         self.has_audio = False
         self.audio_streams = []
         self.audio_streamidx = -1
         self.video_streams = []
         self.video_streamidx = -1
-        #self.ffmpeg_command = ['ffmpeg', '-y', '-nostdin', '-i', f'{self.orig_file}', '-progress', f'unix://{self.socketfile}', '-loglevel', '24']
-        self.ffmpeg_command = ['ffmpeg', '-y', '-nostdin', '-i', f'{self.orig_file}', '-progress', f'unix://{self.socketfile}']
+        self.extra_ladder = celery.conf.get('EXTRA_LADDER') if celery.conf.get('EXTRA_LADDER') in extra_ladders else None
+        self.extra_streams = []
+        self.ladder_files = {}
+        self.forced_keyframes = None
+        self.max_gop = 0
         self.encoded_files = []
+        self.outputs = []
         self.has_work = False
         self.force_profile = None
+        self.checkpoint_time = 0
+        self.checkpoint_progress = 0
+        self.subtitles_extracted = False
 
         self.get_metadata()
-        self.create_streams()
-        self.create_command()
+        self.direct_play = self.direct_play_compatible()
+        if not self.direct_play:
+            self.create_streams()
+            self.create_command()
 
     def __del__(self):
         shutil.rmtree(self.tmpdir, ignore_errors = True)
@@ -202,7 +672,125 @@ class FfmpegTranscode:
             if this_profile:
                 self.video_streams.append(this_profile)
 
-    def create_stream(self, command, filename, stream_type):
+        if celery.conf.get('PER_TITLE_LADDER') and not self.following_upload:
+            self.tune_ladder()
+
+        if celery.conf.get('PASSTHROUGH') and not self.following_upload:
+            self.passthrough()
+
+        if self.extra_ladder:
+            rungs = extra_ladders[self.extra_ladder]
+            for f in self.video_streams:
+                rung = next((r for r in rungs if r['width'] >= f['width']), rungs[-1]).copy()
+                rung['width'] = f['width']
+                self.extra_streams.append(rung)
+
+    def stream_info(self, idx):
+        return next((stream for stream in self.streaminfo['streams'] if stream['index'] == idx), {})
+
+    def video_compatible(self):
+        # H.264 that every player can decode, at a rate a top rung could have
+        stream = self.stream_info(self.video_streamidx)
+        if stream.get('codec_name') != 'h264' or stream.get('pix_fmt') != 'yuv420p':
+            return False
+        if stream.get('profile') not in ['Constrained Baseline', 'Main', 'High'] or stream.get('width', 0) > 1920:
+            return False
+
+        try:
+            rate = int(stream.get('bit_rate') or self.streaminfo['format']['bit_rate']) / 1000
+        except (KeyError, ValueError):
+            return False
+
+        return rate <= celery.conf.get('PASSTHROUGH_MAX_RATE')
+
+    def audio_compatible(self):
+        stream = self.stream_info(self.audio_streamidx)
+        if stream.get('codec_name') != 'aac' or stream.get('profile') != 'LC':
+            return False
+
+        return 0 < stream.get('channels', 0) <= 2 and int(stream.get('bit_rate', 0)) / 1000 <= 320
+
+    def source_keyframes(self):
+        start_time = float(self.streaminfo['format'].get('start_time', 0))
+        keyframes = [keyframe - start_time for keyframe in get_keyframes(self.orig_file, self.video_streamidx, cache=not self.following_upload)]
+        gaps = [b - a for a, b in zip(keyframes, keyframes[1:])]
+
+        # Segments can't be shorter than the source GOPs
+        if not gaps or max(gaps) > dash_size * 2:
+            return None
+
+        return keyframes
+
+    def passthrough(self):
+        if self.has_audio and self.audio_compatible():
+            stream = self.stream_info(self.audio_streamidx)
+            top = max(range(len(self.audio_streams)), key=lambda idx: kbit(self.audio_streams[idx]['rate']))
+            rate = int(int(stream.get('bit_rate', 0)) / 1000)
+            self.audio_streams[top] = {'rate': f'{rate}k' if rate else self.audio_streams[top]['rate'], 'channels': f'{stream["channels"]}', 'copy': True}
+
+        if not self.video_compatible():
+            return
+
+        # A copied stream keeps the keyframes of the source, the encoded rungs
+        # have to put theirs in the same places for the segments to line up.
+        keyframes = self.source_keyframes()
+        if not keyframes:
+            return
+
+        forced_keyframes = ','.join(f'{keyframe:.3f}' for keyframe in keyframes)
+        if len(forced_keyframes) > 100000:
+            return
+
+        self.forced_keyframes = forced_keyframes
+        self.max_gop = max(int(max(b - a for a, b in zip(keyframes, keyframes[1:])) * self.framerate) + 1, self.keyint)
+
+        stream = self.stream_info(self.video_streamidx)
+        top = max(range(len(self.video_streams)), key=lambda idx: self.video_streams[idx]['width'])
+        self.video_streams[top] = dict(self.video_streams[top], width=stream['width'], copy=True)
+
+    def direct_play_compatible(self):
+        if not celery.conf.get('DIRECT_PLAY') or self.following_upload:
+            return False
+
+        if 'mp4' not in self.streaminfo['format'].get('format_name', ''):
+            return False
+
+        video_streams = [s for s in self.streaminfo['streams'] if s['codec_type'] == 'video' and not s.get('disposition', {}).get('attached_pic')]
+        audio_streams = [s for s in self.streaminfo['streams'] if s['codec_type'] == 'audio']
+        if len(video_streams) != 1 or len(audio_streams) > 1:
+            return False
+
+        if not self.video_compatible() or (self.has_audio and not self.audio_compatible()):
+            return False
+
+        # Browsers can only start playing progressively with the index first
+        return index_first(self.orig_file, os.path.getsize(self.orig_file))
+
+    def run_direct_play(self):
+        self.start()
+
+        direct_file = f'{self.outdir}/direct.mp4'
+        link_or_copy(self.orig_file, direct_file)
+        if celery.conf.get('STORAGE_BACKEND') == "S3":
+            get_transfer_engine().upload([direct_file])
+
+        self.make_thumbnails()
+        self.make_poster()
+        if celery.conf.get('STORAGE_BACKEND') == "S3":
+            get_transfer_engine().upload(self.thumbnail_files() + self.poster_files())
+
+        self.video.playlist = f'{self.video.id}/direct.mp4'
+        self.video.encoding_progress = 100
+        self.video.status = 'ready'
+        self.video.watchable = True
+        db_session.commit()
+        publish_progress(self.video)
+
+    def tune_ladder(self):
+        analysis = LadderAnalysis(celery.conf, self.orig_file, self.video_streamidx, self.duration, self.vwidth + self.vwidth % 2, self.vheight + self.vheight % 2, self.tmpdir)
+        self.video_streams = analysis.prune(self.video_streams, self.video_command)
+
+    def create_stream(self, command, filename, stream_type, ladder='h264'):
         outfile = f'{self.outdir}/{filename}'
         command_hash = hashlib.sha256(str(command).encode('utf-8')).hexdigest()
 
@@ -221,6 +809,17 @@ class FfmpegTranscode:
             else:
                 encoded_file = file
 
+        if not encoded_file and stream_type != 'dash' and self.reuse_stream(filename, command_hash):
+            encoded_file = models.EncodedFile(
+                video_id = self.video.id,
+                encoded_file_name = filename,
+                encoding_hash = command_hash,
+                track_type = stream_type
+            )
+
+            db_session.add(encoded_file)
+            db_session.commit()
+
         if not encoded_file:
             encoded_file = models.EncodedFile(
                 video_id = self.video.id,
@@ -230,25 +829,114 @@ class FfmpegTranscode:
             )
 
             self.encoded_files.append(encoded_file)
-            self.ffmpeg_command.extend(command)
-            self.ffmpeg_command.append(outfile)
+            self.outputs.append({'command': command, 'filename': filename, 'track_type': stream_type, 'ladder': ladder})
             self.has_work = True
 
+    def reuse_stream(self, filename, command_hash):
+        if not self.video.content_hash:
+            return False
+
+        # Another upload of the same source encoded with the same command
+        # produced the exact file we need, link it instead of encoding it again.
+        encoded_files = db_session.query(models.EncodedFile).join(models.Video, models.Video.id == models.EncodedFile.video_id).filter(
+            models.Video.content_hash == self.video.content_hash,
+            models.Video.id != self.video.id,
+            models.EncodedFile.encoded_file_name == filename,
+            models.EncodedFile.encoding_hash == command_hash,
+        ).all()
+
+        for encoded_file in encoded_files:
+            source = f"{celery.conf.get('MOVIE_PATH')}/{encoded_file.video_id}/{filename}"
+            if os.path.exists(source):
+                print(f'Reusing {source}')
+                link_or_copy(source, f'{self.outdir}/{filename}')
+                return True
+
+        return False
+
+    def dash_command(self, streams, prefix=''):
+        command = []
+        counts = {'video': 0, 'audio': 0}
+        sets = {}
+        for idx, (stream_command, filename, stream_type, ladder) in enumerate(streams):
+            command.extend(stream_options(stream_command, stream_type[0], counts[stream_type]))
+            counts[stream_type] += 1
+
+            # Every ladder gets an adaptation set of its own, players only
+            # pick the codecs they can decode.
+            sets.setdefault(ladder if stream_type == 'video' else stream_type, []).append(f'{idx}')
+            if stream_type == 'video' and ladder in self.ladder_files:
+                self.ladder_files[ladder].append([f'{prefix}init-{idx}.m4s', f'{prefix}chunk-{idx}-*.m4s'])
+
+        adaptation_sets = ' '.join(f'id={num},streams={",".join(idxs)}' for num, idxs in enumerate(sets.values()))
+
+        command.extend(['-map_chapters', '-1', '-f', 'dash', '-seg_duration', f'{dash_size}', '-use_template', '1', '-use_timeline', '1',
+            '-dash_segment_type', 'mp4', '-adaptation_sets', adaptation_sets,
+            '-init_seg_name', f'{prefix}init-$RepresentationID$.m4s', '-media_seg_name', f'{prefix}chunk-$RepresentationID$-$Number%05d$.m4s'])
+
+        return command
+
+    def keyframe_options(self):
+        if self.forced_keyframes:
+            return ['-force_key_frames', self.forced_keyframes, '-g', f'{self.max_gop}', '-sc_threshold', '0']
+
+        return ['-keyint_min', f'{self.keyint}', '-g', f'{self.keyint}', '-sc_threshold', '0']
+
+    def video_command(self, f):
+        if f.get('copy'):
+            return ['-map', f'0:{self.video_streamidx}', '-an', '-sn', '-dn', '-c:v', 'copy', '-map_chapters', '-1']
+
+        return ['-map', f'0:{self.video_streamidx}', '-an', '-sn', '-dn', f'-c:v', 'libx264', '-x264-params', f'no-scenecut', f'-profile:v', f['profile'], '-preset:v', f["preset"], '-tune:v', self.video.tune] + self.keyframe_options() + [
+            '-bf', '1', '-b_strategy', '0',
+            f'-crf', f['crf'], f'-maxrate', f'{f["maxrate"]}', f'-bufsize', f'{f["bufsize"]}', f'-filter:v', f'scale={f["width"]}:-2,format={f["pix_fmt"]}',
+            '-map_chapters', '-1', '-aspect', f'{self.vwidth}:{self.vheight}']
+
+    def audio_command(self, f):
+        if f.get('copy'):
+            return ['-map', f'0:{self.audio_streamidx}', '-vn', '-sn', '-dn', '-c:a', 'copy', '-map_chapters', '-1']
+
+        return ['-map', f'0:{self.audio_streamidx}', '-vn', '-sn', '-dn', f'-c:a', 'aac', f'-b:a', f['rate'], f'-ac', f['channels'], '-map_chapters', '-1']
+
     def create_command(self):
+        streams = []
         for num, f in enumerate(self.video_streams):
-            filename = f'video_{f["width"]}_{f["maxrate"]}.mp4'
-            command = ['-map', f'0:{self.video_streamidx}', '-an', '-sn', '-dn', f'-c:v', 'libx264', '-x264-params', f'no-scenecut', f'-profile:v', f['profile'], '-preset:v', f["preset"], '-tune:v', self.video.tune,
-                '-keyint_min', f'{self.keyint}', '-g', f'{self.keyint}', '-sc_threshold', '0', '-bf', '1', '-b_strategy', '0',
-                f'-crf', f['crf'], f'-maxrate', f'{f["maxrate"]}', f'-bufsize', f'{f["bufsize"]}', f'-filter:v', f'scale={f["width"]}:-2,format={f["pix_fmt"]}',
-                '-map_chapters', '-1', '-aspect', f'{self.vwidth}:{self.vheight}']
+            filename = f'video_{f["width"]}_{f["maxrate"]}.mp4' if not f.get('copy') else f'video_{f["width"]}_copy.mp4'
+            streams.append((self.video_command(f), filename, 'video', 'h264'))
+
+        for num, f in enumerate(self.extra_streams):
+            filename = f'video_{f["width"]}_{f["maxrate"]}_{self.extra_ladder}.mp4'
+            command = ['-map', f'0:{self.video_streamidx}', '-an', '-sn', '-dn'] + extra_ladder_options(self.extra_ladder, f, self.keyint) + [
+                f'-filter:v', f'scale={f["width"]}:-2,format=yuv420p', '-map_chapters', '-1', '-aspect', f'{self.vwidth}:{self.vheight}']
 
-            self.create_stream(command, filename, 'video')
+            streams.append((command, filename, 'video', self.extra_ladder))
 
         for num, f in enumerate(self.audio_streams):
-            filename = f'audio_{f["rate"]}.mp4'
-            command = ['-map', f'0:{self.audio_streamidx}', '-vn', '-sn', '-dn', f'-c:a', 'aac', f'-b:a', f['rate'], f'-ac', f['channels'], '-map_chapters', '-1']
+            filename = f'audio_{f["rate"]}.mp4' if not f.get('copy') else f'audio_{f["rate"]}_copy.mp4'
+            streams.append((self.audio_command(f), filename, 'audio', 'h264'))
+
+        for command, filename, stream_type, ladder in streams:
+            if stream_type == 'video':
+                self.ladder_files.setdefault(ladder, [])
+
+        # The dash muxer writes the segments and manifest while encoding, so
+        # the whole ladder becomes a single output.
+        if celery.conf.get('PACKAGER') == 'ffmpeg':
+            self.create_stream(self.dash_command(streams), 'playlist.mpd', 'dash', 'dash')
+            return
+
+        for command, filename, stream_type, ladder in streams:
+            if stream_type == 'video':
+                self.ladder_files[ladder].append([filename])
+            self.create_stream(command, filename, stream_type, ladder)
 
-            self.create_stream(command, filename, 'audio')
+    def ladder_command(self, ladder, input_file):
+        command = ['ffmpeg', '-y', '-nostdin', '-i', f'{input_file}', '-progress', f'unix://{self.socketfile}']
+        for output in self.outputs:
+            if output['ladder'] == ladder:
+                command.extend(output['command'])
+                command.append(f'{self.outdir}/{output["filename"]}')
+
+        return command
 
     def run_ffmpeg(self, command, logfile, retval):
         print(f'Executing: {" ".join(command)}')
@@ -257,39 +945,76 @@ class FfmpegTranscode:
             print(f"run_ffmpeg: {ret.returncode}")
             retval.value = ret.returncode
 
-    def ffmpeg_progress(self, logfile):
+    def checkpoint_due(self, percentage):
+        now = time.monotonic()
+        if percentage < 100 and percentage - self.checkpoint_progress < 1 and now - self.checkpoint_time < celery.conf.get('PROGRESS_CHECKPOINT_INTERVAL'):
+            return False
+
+        self.checkpoint_time = now
+        self.checkpoint_progress = percentage
+        return True
+
+    def update_progress(self, percentage, speed):
+        self.video.encoding_progress = percentage
+        self.video.encoding_speed = speed
+        publish_progress(self.video)
+
+        if self.checkpoint_due(percentage):
+            db_session.commit()
+
+    def ffmpeg_progress(self, logfile, command, duration=None, update_progress=None):
+        duration = duration or self.duration
+        update_progress = update_progress or self.update_progress
+
+        # Every pass binds the socket again, the previous one left its path
+        rm_f(self.socketfile)
         sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         sock.settimeout(15)
         sock.bind(self.socketfile)
         sock.listen(1)
 
         ffmpeg_retval = multiprocessing.Value('i', -1)
-        ffmpeg = multiprocessing.Process(target=self.run_ffmpeg, args=(self.ffmpeg_command, logfile, ffmpeg_retval))
+        ffmpeg = multiprocessing.Process(target=self.run_ffmpeg, args=(command, logfile, ffmpeg_retval))
         ffmpeg.start()
         percentage = 0
         speed = 0
         ffmpeg_clean_end = False
+        lease_lost = False
+        connection = None
+        buf = b''
 
         try:
             connection, client_address = sock.accept()
             while True:
                 data = connection.recv(1024)
                 if data:
-                    string = data.decode('utf-8')
-                    for line in string.splitlines():
-                        if line.startswith('out_time_ms'):
-                            progress = int(line.split('=')[1].strip()) / 1000000
-                            percentage = (progress / self.duration) * 100
-                            percentage = min(percentage, 100)
-                        if line.startswith('speed'):
-                            speed = float(line.split('=')[1].strip().split('x')[0])
-                        if line.startswith('progress'):
-                            if line.split('=')[1].strip() == 'end':
+                    # A recv can end halfway through a line, keep the
+                    # unfinished part around until the rest of it arrives.
+                    buf = buf + data
+                    lines = buf.split(b'\n')
+                    buf = lines.pop()
+
+                    for line in lines:
+                        key, _, value = line.decode('utf-8', 'replace').partition('=')
+                        value = value.strip()
+                        try:
+                            if key == 'out_time_ms':
+                                progress = int(value) / 1000000
+                                percentage = (progress / duration) * 100
+                                percentage = min(percentage, 100)
+                            if key == 'speed':
+                                speed = float(value.split('x')[0])
+                        except ValueError:
+                            pass
+                        if key == 'progress':
+                            if value == 'end':
                                 ffmpeg_clean_end = True
 
-                    self.video.encoding_progress = percentage
-                    self.video.encoding_speed = speed
-                    db_session.commit()
+                    update_progress(percentage, speed)
+
+                    if self.lease and self.lease.lost:
+                        lease_lost = True
+                        break
                 else:
                     break
         except socket.timeout:
@@ -299,9 +1024,16 @@ class FfmpegTranscode:
             # Give ffmpeg time to shut down
             time.sleep(2)
             ffmpeg.terminate()
-            connection.close()
+            if connection:
+                connection.close()
+            sock.close()
+            rm_f(self.socketfile)
 
             print(f"ffmpeg_clean: {ffmpeg_clean_end}, ffmpeg_retval: {ffmpeg_retval.value}")
+            if lease_lost:
+                print(f'Another job took over {self.video.id}, stopping')
+                raise Ignore
+
             if ffmpeg_clean_end and ffmpeg_retval.value == 0:
                 return
 
@@ -316,23 +1048,621 @@ class FfmpegTranscode:
                     
             raise FfmpegException(status)
 
-    def run(self):
+    def start(self):
         self.video.status = 'encoding'
         self.video.width = self.vwidth
         self.video.height = self.vheight
         self.video.duration = self.duration
         db_session.commit()
+        publish_progress(self.video)
+
+    def encode_pass(self, logfile, command, input_file, update_progress):
+        follower = None
+        if input_file != self.orig_file:
+            os.mkfifo(input_file)
+            follower = UploadFollower(self.video, self.orig_file, input_file)
+            follower.start()
+
+        try:
+            self.ffmpeg_progress(logfile, command, update_progress=update_progress)
+        finally:
+            if follower:
+                follower.stop()
+
+        if follower and not follower.complete:
+            raise FfmpegException('The upload did not finish while encoding')
+
+    def run(self):
+        self.start()
 
         if self.has_work:
-            self.ffmpeg_progress(f'{self.orig_file}.log')
+            ladders = []
+            for output in self.outputs:
+                if output['ladder'] not in ladders:
+                    ladders.append(output['ladder'])
+
+            # Every ladder is encoded in a pass of its own so the time each
+            # codec takes can be told apart.
+            timings = {}
+            input_file = self.input_file
+            thumbnails = self.wants_thumbnails()
+            if thumbnails:
+                self.remove_thumbnails()
+
+            for num, ladder in enumerate(ladders):
+                def update_progress(percentage, speed):
+                    self.update_progress((num * 100 + percentage) / len(ladders), speed)
+
+                logfile = f'{self.orig_file}.log' if ladder in ['h264', 'dash'] else f'{self.orig_file}.{ladder}.log'
+
+                # Reused rungs are hard links to another video's files, ffmpeg
+                # would truncate those in place.
+                for output in self.outputs:
+                    if output['ladder'] == ladder:
+                        rm_f(f'{self.outdir}/{output["filename"]}')
+
+                command = self.ladder_command(ladder, input_file)
+                if num == 0:
+                    command.extend(self.subtitle_options())
+                    if thumbnails:
+                        command.extend(self.thumbnail_options())
+
+                started = time.monotonic()
+                self.encode_pass(logfile, command, input_file, update_progress)
+                timings[ladder] = time.monotonic() - started
+
+                # Only the first pass has to wait for the upload
+                input_file = self.orig_file
+                self.subtitles_extracted = True
+
+            if thumbnails:
+                self.write_thumbnail_index()
+
             for encoded_file in self.encoded_files:
                 db_session.add(encoded_file)
             db_session.commit()
 
+            self.record_ladder_stats(timings)
+
+    def record_ladder_stats(self, timings):
+        db_session.query(models.LadderStats).filter_by(video_id = self.video.id).delete()
+
+        for ladder, renditions in self.ladder_files.items():
+            size = 0
+            for patterns in renditions:
+                for pattern in patterns:
+                    size = size + sum(os.path.getsize(f) for f in glob.glob(f'{self.outdir}/{pattern}'))
+
+            stats = models.LadderStats(
+                video_id = self.video.id,
+                ladder = ladder,
+                renditions = len(renditions),
+                encoded_size = size,
+                encoding_time = timings.get(ladder)
+            )
+            db_session.add(stats)
+
+            encoding_time = f'{stats.encoding_time:.0f}s' if stats.encoding_time is not None else 'unknown'
+            print(f'{ladder}: {stats.renditions} renditions, {size / (1024 * 1024):.1f} MiB, encoding time {encoding_time}')
+
+        db_session.commit()
+
+    def wants_thumbnails(self):
+        return celery.conf.get('THUMBNAILS') and not self.thumbnails_current()
+
+    def thumbnail_index(self):
+        return f'{self.outdir}/thumbnails.vtt'
+
+    def thumbnail_files(self):
+        return sorted(glob.glob(f'{self.outdir}/thumbs-*.jpg')) + [f for f in [self.thumbnail_index()] if os.path.exists(f)]
+
+    def thumbnail_size(self):
+        width = celery.conf.get('THUMBNAIL_WIDTH')
+        return width, max(round(width * self.vheight / self.vwidth / 2) * 2, 2)
+
+    def thumbnails_key(self):
+        settings = [celery.conf.get('THUMBNAIL_INTERVAL'), celery.conf.get('THUMBNAIL_TILE'), self.thumbnail_size()]
+        return hashlib.sha256(str([probe_key(self.orig_file), settings]).encode('utf-8')).hexdigest()
+
+    def thumbnails_current(self):
+        try:
+            with open(self.thumbnail_index()) as f:
+                return f'NOTE {self.thumbnails_key()}' in f.read(256)
+        except OSError:
+            return False
+
+    def remove_thumbnails(self):
+        for f in self.thumbnail_files():
+            rm_f(f)
+
+    def thumbnail_options(self):
+        # An extra output on a pass that decodes the whole source anyway,
+        # the sheets then cost little more than scaling one frame in a few hundred.
+        width, height = self.thumbnail_size()
+        interval = celery.conf.get('THUMBNAIL_INTERVAL')
+        tile = celery.conf.get('THUMBNAIL_TILE')
+
+        return ['-map', f'0:{self.video_streamidx}', '-an', '-sn', '-dn', '-filter:v', f'fps=1/{interval},scale={width}:{height},tile={tile}',
+            '-q:v', '5', '-f', 'image2', f'{self.outdir}/thumbs-%03d.jpg']
+
+    def write_thumbnail_index(self):
+        width, height = self.thumbnail_size()
+        interval = celery.conf.get('THUMBNAIL_INTERVAL')
+        columns, rows = [int(n) for n in celery.conf.get('THUMBNAIL_TILE').split('x')]
+
+        sheets = len(glob.glob(f'{self.outdir}/thumbs-*.jpg'))
+        count = min(math.ceil(self.duration / interval), sheets * columns * rows)
+
+        # The key of the source and settings goes in a comment, so a later
+        # encode of the same file can tell these sheets are still good.
+        index = self.thumbnail_index()
+        with open(f'{index}.tmp', 'w') as f:
+            f.write(f'WEBVTT\n\nNOTE {self.thumbnails_key()}\n\n')
+            for num in range(count):
+                sheet, tile = divmod(num, columns * rows)
+                start = num * interval
+                end = min(start + interval, self.duration)
+                f.write(f'{vtt_timestamp(start)} --> {vtt_timestamp(end)}\n')
+                f.write(f'thumbs-{sheet + 1:03d}.jpg#xywh={tile % columns * width},{tile // columns * height},{width},{height}\n\n')
+        os.replace(f'{index}.tmp', index)
+
+    def make_thumbnails(self):
+        if not celery.conf.get('THUMBNAILS'):
+            self.video.thumbnails = None
+            return
+
+        # Units and direct play never decode the whole source in one pass,
+        # keyframes are close enough for a preview and cheap to decode.
+        if not self.thumbnails_current():
+            self.remove_thumbnails()
+            command = ['ffmpeg', '-y', '-nostdin', '-skip_frame', 'nokey', '-i', self.orig_file] + self.thumbnail_options()
+            print(f'Executing: {" ".join(command)}')
+            if subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0:
+                print('Creating thumbnails failed')
+                self.video.thumbnails = None
+                return
+
+            self.write_thumbnail_index()
+
+        self.video.thumbnails = f'{self.video.id}/thumbnails.vtt'
+
+    def subtitle_streams(self):
+        # Bitmap subtitles would need OCR, only text tracks are extracted
+        return [s for s in self.streaminfo['streams'] if s['codec_type'] == 'subtitle' and s.get('codec_name') in text_subtitle_codecs]
+
+    def subtitle_options(self):
+        options = []
+        for stream in self.subtitle_streams():
+            options.extend(['-map', f'0:{stream["index"]}', '-c:s', 'webvtt', '-f', 'webvtt', f'{self.outdir}/subtitle_internal_{stream["index"]}.vtt'])
+
+        return options
+
+    def make_subtitles(self):
+        # Unit encodes don't have a pass over the whole file to add these to,
+        # pulling text streams out on their own only costs a demux.
+        options = self.subtitle_options()
+        if options and not self.subtitles_extracted:
+            command = ['ffmpeg', '-y', '-nostdin', '-i', self.orig_file] + options
+            print(f'Executing: {" ".join(command)}')
+            if subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0:
+                print('Extracting subtitles failed')
+
+        existing = {s.internal_streamidx: s for s in self.video.subtitles if s.internal}
+        for stream in self.subtitle_streams():
+            filename = f'subtitle_internal_{stream["index"]}.vtt'
+            if not os.path.exists(f'{self.outdir}/{filename}'):
+                continue
+
+            subtitle = existing.pop(stream['index'], None)
+            if not subtitle:
+                tags = stream.get('tags', {})
+                subtitle = models.Subtitle(
+                    video_id = self.video.id,
+                    language = tags.get('language', 'und')[:5],
+                    title = tags.get('title') or tags.get('language', 'und'),
+                    internal = True,
+                    internal_streamidx = stream['index'],
+                    internal_include = True
+                )
+                db_session.add(subtitle)
+
+            subtitle.encoded_file = f'{self.video.id}/{filename}'
+
+        for subtitle in existing.values():
+            db_session.delete(subtitle)
+        db_session.commit()
+
+    def poster_files(self):
+        return glob.glob(f'{self.outdir}/poster-*.jpg')
+
+    def make_poster(self):
+        if self.video.poster_file and os.path.exists(f"{celery.conf.get('MOVIE_PATH')}/{self.video.poster_file}"):
+            return
+
+        width = min(celery.conf.get('POSTER_WIDTH'), self.vwidth)
+        width = width - width % 2
+        height = max(round(width * self.vheight / self.vwidth / 2) * 2, 2)
+
+        # Skip past intros and studio logos, then let the thumbnail filter
+        # pick the frame most like the others around it.
+        posterfile = os.path.join(self.tmpdir, 'poster.jpg')
+        command = ['ffmpeg', '-y', '-nostdin', '-ss', f'{self.duration * 0.2}', '-i', self.orig_file, '-map', f'0:{self.video_streamidx}', '-an', '-sn', '-dn',
+            '-filter:v', f'thumbnail=100,scale={width}:{height}', '-frames:v', '1', '-q:v', '3', posterfile]
+        print(f'Executing: {" ".join(command)}')
+        if subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0 or not os.path.exists(posterfile):
+            print('Creating poster failed')
+            return
+
+        with open(posterfile, 'rb') as f:
+            filename = f'poster-{hashlib.sha256(f.read()).hexdigest()[:16]}.jpg'
+
+        for f in self.poster_files():
+            if os.path.basename(f) != filename:
+                rm_f(f)
+                if celery.conf.get('STORAGE_BACKEND') == 'S3':
+                    get_transfer_engine().delete_prefix(f'{self.video.id}/{os.path.basename(f)}')
+
+        shutil.move(posterfile, f'{self.outdir}/{filename}')
+        self.video.poster_file = f'{self.video.id}/{filename}'
+
+    def wants_fast_start(self):
+        return celery.conf.get('FAST_START') and self.has_work and len(self.video_streams) > 1
+
+    def fast_start_streams(self):
+        # A single mid rung with a fast preset, just enough to start watching
+        # while the full ladder is encoded.
+        rung = self.video_streams[0]
+        for f in self.video_streams:
+            if f['width'] <= 960:
+                rung = f
+
+        rung = rung.copy()
+        rung['preset'] = 'veryfast'
+        streams = [(self.video_command(rung), f'fast_video_{rung["width"]}_{rung["maxrate"]}.mp4', 'video', 'fast')]
+
+        if self.audio_streams:
+            f = self.audio_streams[min(1, len(self.audio_streams) - 1)]
+            streams.append((self.audio_command(f), f'fast_audio_{f["rate"]}.mp4', 'audio', 'fast'))
+
+        return streams
+
+    def run_fast_start(self):
+        manifest = f'{self.outdir}/fast.mpd'
+        playlist = f'{self.video.id}/fast.mpd'
+
+        # Picked up again after a restart, rooms may already be watching it
+        if self.video.watchable and self.video.playlist == playlist and os.path.exists(manifest):
+            return
+
+        self.start()
+        for f in glob.glob(f'{self.outdir}/fast[_.-]*'):
+            rm_f(f)
+
+        streams = self.fast_start_streams()
+        command = ['ffmpeg', '-y', '-nostdin', '-i', f'{self.input_file}', '-progress', f'unix://{self.socketfile}']
+        if celery.conf.get('PACKAGER') == 'ffmpeg':
+            command.extend(self.dash_command(streams, 'fast-'))
+            command.append(manifest)
+        else:
+            for stream_command, filename, stream_type, ladder in streams:
+                command.extend(stream_command)
+                command.append(f'{self.outdir}/{filename}')
+
+        # Early viewers get seek previews too, the full encode keeps these
+        thumbnails = self.wants_thumbnails()
+        if thumbnails:
+            self.remove_thumbnails()
+            command.extend(self.thumbnail_options())
+
+        self.encode_pass(f'{self.orig_file}.fast.log', command, self.input_file, self.update_progress)
+        self.input_file = self.orig_file
+
+        if thumbnails:
+            self.write_thumbnail_index()
+
+        if celery.conf.get('PACKAGER') != 'ffmpeg':
+            video_files = [f'{self.outdir}/{filename}' for _, filename, stream_type, _ in streams if stream_type == 'video']
+            audio_files = [f'{self.outdir}/{filename}' for _, filename, stream_type, _ in streams if stream_type == 'audio']
+            if mp4box_package(self.video, self.outdir, manifest, video_files, audio_files) != 'ready':
+                raise FfmpegException('Packaging the provisional encode failed')
+
+        if thumbnails:
+            self.video.thumbnails = f'{self.video.id}/thumbnails.vtt'
+        self.make_poster()
+
+        if celery.conf.get('STORAGE_BACKEND') == "S3":
+            files = [f for f in glob.glob(f'{self.outdir}/fast[_.-]*') if f != manifest]
+            get_transfer_engine().upload(files + self.thumbnail_files() + self.poster_files())
+            get_transfer_engine().upload([manifest])
+
+        # Rooms load whatever the playlist points at, the full manifest only
+        # takes over once it is complete and the provisional one stays around
+        # for anyone still watching it.
+        self.video.playlist = playlist
+        self.video.watchable = True
+        self.video.encoding_progress = 0
+        db_session.commit()
+        publish_progress(self.video)
+
+    def wants_units(self):
+        if not self.has_work or self.following_upload or celery.conf.get('PACKAGER') == 'ffmpeg':
+            return False
+
+        # Forced keyframe times are relative to the whole file
+        if celery.conf.get('PARALLEL_ENCODING') == 'segments':
+            if self.forced_keyframes:
+                return False
+            return self.duration > celery.conf.get('SEGMENT_LENGTH') * 2
+
+        if celery.conf.get('PARALLEL_ENCODING') == 'renditions':
+            return len(self.outputs) > 1
+
+        return False
+
+    def split_ranges(self):
+        length = celery.conf.get('SEGMENT_LENGTH')
+        start_time = float(self.streaminfo['format'].get('start_time', 0))
+
+        # Only cut on source keyframes so every range can be seeked to exactly
+        # and the encoded pieces join back together without gaps.
+        boundaries = [0.0]
+        for keyframe in get_keyframes(self.orig_file, self.video_streamidx, cache=not self.following_upload):
+            keyframe = keyframe - start_time
+            if keyframe >= boundaries[-1] + length and self.duration - keyframe >= length / 2:
+                boundaries.append(keyframe)
+        boundaries.append(self.duration)
+
+        return list(zip(boundaries, boundaries[1:]))
+
+    def unit_hash(self, unit):
+        outputs = [(output['command'], output['filename']) for output in self.unit_outputs(unit)]
+        return hashlib.sha256(str([outputs, unit.start, unit.end]).encode('utf-8')).hexdigest()
+
+    def unit_finished(self, unit):
+        if not unit.done:
+            return False
+
+        if unit.encoded_file_name:
+            return os.path.exists(f'{self.outdir}/{unit.encoded_file_name}')
+
+        return all(os.path.exists(f'{self.unit_dir(unit)}/{output["filename"]}') for output in self.unit_outputs(unit))
+
+    def create_units(self, mode):
+        units = []
+        track_types = set(output['track_type'] for output in self.outputs)
+
+        if mode == 'renditions':
+            for output in self.outputs:
+                units.append(models.EncodingUnit(video_id = self.video.id, track_type = output['track_type'], ladder = output['ladder'], encoded_file_name = output['filename'], start = 0, end = self.duration))
+            track_types = set()
+
+        if 'video' in track_types:
+            ladders = []
+            for output in self.outputs:
+                if output['track_type'] == 'video' and output['ladder'] not in ladders:
+                    ladders.append(output['ladder'])
+
+            ranges = self.split_ranges()
+            for ladder in ladders:
+                for start, end in ranges:
+                    units.append(models.EncodingUnit(video_id = self.video.id, track_type = 'video', ladder = ladder, start = start, end = end))
+
+        # Audio is cheap to encode and AAC doesn't survive being cut and joined
+        # without clicks at every boundary, so it always gets a single unit.
+        if 'audio' in track_types:
+            units.append(models.EncodingUnit(video_id = self.video.id, track_type = 'audio', start = 0, end = self.duration))
+
+        # Units that a previous run already finished with the exact same
+        # commands are kept, anything else is encoded again.
+        existing = {}
+        for unit in db_session.query(models.EncodingUnit).filter_by(video_id = self.video.id).all():
+            if unit.encoding_hash and self.unit_finished(unit):
+                existing[unit.encoding_hash] = unit
+            else:
+                db_session.delete(unit)
+
+        for num, unit in enumerate(units):
+            unit.encoding_hash = self.unit_hash(unit)
+            if unit.encoding_hash in existing:
+                units[num] = existing.pop(unit.encoding_hash)
+                print(f'Resuming after finished unit {units[num].id}')
+            else:
+                db_session.add(unit)
+
+        for unit in existing.values():
+            db_session.delete(unit)
+        db_session.commit()
+
+        worker_redis.delete(self.units_key())
+        for unit in units:
+            self.store_unit_progress(unit)
+
+        return units
+
+    def run_units(self):
+        self.start()
+        units = self.create_units(celery.conf.get('PARALLEL_ENCODING'))
+
+        header = [transcode_unit.si(unit.id, self.lease.token) for unit in units if not unit.done]
+        if not header:
+            finish_units.delay(self.video.id, self.lease.token)
+            return
+
+        chord(header)(finish_units.si(self.video.id, self.lease.token))
+
+    def wants_checkpoints(self):
+        if not celery.conf.get('RESUMABLE_ENCODING') or not self.has_work:
+            return False
+
+        if self.following_upload or self.forced_keyframes or celery.conf.get('PACKAGER') == 'ffmpeg':
+            return False
+
+        return self.duration > celery.conf.get('SEGMENT_LENGTH') * 2
+
+    def run_checkpointed(self):
+        # The same units as segment-parallel encoding, just one after the
+        # other in this task. Every finished unit survives a restart.
+        self.start()
+        for unit in self.create_units('segments'):
+            if not unit.done:
+                self.run_unit(unit)
+
+        self.merge_units()
+
+    def unit_dir(self, unit):
+        return f'{self.outdir}/.units/{unit.id}'
+
+    def units_key(self):
+        return f'encoding-units:{self.video.id}'
+
+    def store_unit_progress(self, unit):
+        state = {
+            'track_type': unit.track_type,
+            'length': unit.end - unit.start,
+            'progress': unit.encoding_progress or 0,
+            'speed': unit.encoding_speed or 0,
+        }
+
+        worker_redis.hset(self.units_key(), unit.id, json.dumps(state))
+        worker_redis.expire(self.units_key(), 60 * 60 * 24)
+
+    def update_unit_progress(self, unit, percentage, speed):
+        unit.encoding_progress = percentage
+        unit.encoding_speed = speed
+        self.store_unit_progress(unit)
+
+        # Every unit keeps its latest progress in Redis so the total can be
+        # worked out without reading every unit row back from the database.
+        units = [json.loads(u) for u in worker_redis.hvals(self.units_key())]
+        units = [u for u in units if u['track_type'] == 'video'] or units
+
+        total = sum(u['length'] for u in units)
+        self.video.encoding_progress = sum(u['progress'] * u['length'] for u in units) / total
+
+        # Ranges of one rendition add up, renditions of one range all have to
+        # finish so the slowest one sets the pace.
+        speeds = [u['speed'] for u in units if u['progress'] < 100]
+        if unit.encoded_file_name:
+            self.video.encoding_speed = min(speeds, default=0)
+        else:
+            self.video.encoding_speed = sum(speeds)
+        publish_progress(self.video)
+
+        if self.checkpoint_due(percentage):
+            db_session.commit()
+
+    def run_unit(self, unit):
+        unitdir = self.unit_dir(unit)
+        os.makedirs(unitdir, exist_ok=True)
+
+        command = ['ffmpeg', '-y', '-nostdin']
+        if unit.start > 0:
+            command.extend(['-ss', f'{unit.start}'])
+        command.extend(['-i', f'{self.orig_file}', '-progress', f'unix://{self.socketfile}'])
+
+        range_command = []
+        if unit.end < self.duration:
+            range_command = ['-t', f'{unit.end - unit.start}']
+
+        outputs = self.unit_outputs(unit)
+        for output in outputs:
+            command.extend(output['command'])
+            command.extend(range_command)
+            command.append(f'{unitdir}/{output["filename"]}')
+
+        def update_progress(percentage, speed):
+            self.update_unit_progress(unit, percentage, speed)
+
+        if outputs:
+            started = time.monotonic()
+            self.ffmpeg_progress(f'{unitdir}/ffmpeg.log', command, unit.end - unit.start, update_progress)
+            unit.encoding_time = time.monotonic() - started
+        unit.done = True
+
+        # A rendition is complete on its own, so record it right away. That way
+        # a retry or a later re-encode only redoes the renditions that failed.
+        if unit.encoded_file_name:
+            for encoded_file in self.encoded_files:
+                if encoded_file.encoded_file_name == unit.encoded_file_name:
+                    os.replace(f'{unitdir}/{unit.encoded_file_name}', f'{self.outdir}/{unit.encoded_file_name}')
+                    db_session.add(encoded_file)
+
+        # Finished units are skipped when the encode is picked up again
+        db_session.commit()
+        update_progress(100, 0)
+
+    def unit_outputs(self, unit):
+        outputs = []
+        for output in self.outputs:
+            if output['track_type'] != unit.track_type or output['ladder'] != unit.ladder:
+                continue
+            if unit.encoded_file_name and output['filename'] != unit.encoded_file_name:
+                continue
+            outputs.append(output)
+
+        return outputs
+
+    def merge_units(self):
+        units = db_session.query(models.EncodingUnit).filter_by(video_id = self.video.id).order_by(models.EncodingUnit.start).all()
+
+        for output in self.outputs:
+            outfile = f'{self.outdir}/{output["filename"]}'
+            parts = [f'{self.unit_dir(unit)}/{output["filename"]}' for unit in units if output in self.unit_outputs(unit)]
+
+            if len(parts) == 1:
+                os.replace(parts[0], outfile)
+                continue
+
+            listfile = os.path.join(self.tmpdir, 'concat.txt')
+            with open(listfile, 'w') as lf:
+                for part in parts:
+                    lf.write(f"file '{os.path.abspath(part)}'\n")
+
+            rm_f(outfile)
+            command = ['ffmpeg', '-y', '-nostdin', '-f', 'concat', '-safe', '0', '-i', listfile, '-map', '0', '-c', 'copy', outfile]
+            print(f'Executing: {" ".join(command)}')
+            ret = subprocess.run(command, stderr=subprocess.DEVNULL)
+            if ret.returncode != 0:
+                raise FfmpegException(f'Joining {output["filename"]} failed')
+
+        for encoded_file in self.encoded_files:
+            db_session.add(encoded_file)
+
+        timings = {}
+        for unit in units:
+            if unit.encoding_time is not None and unit.track_type == 'video':
+                timings[unit.ladder] = timings.get(unit.ladder, 0) + unit.encoding_time
+            db_session.delete(unit)
+        db_session.commit()
+
+        shutil.rmtree(f'{self.outdir}/.units', ignore_errors = True)
+
+        self.record_ladder_stats(timings)
+
+def encoding_failed(video, task, message):
+    video.status = 'error'
+    video.status_message = message
+    db_session.commit()
+    publish_progress(video)
+
+    task.update_state(
+        state = states.FAILURE,
+        meta = message
+    )
+
+    raise Ignore()
+
 @celery.task(bind=True)
-def transcode(self, video_id):
+def transcode(self, video_id, lease_token=None):
+    lease = VideoLease(video_id, lease_token)
+    if not (lease.renew() if lease_token else lease.acquire()):
+        print(f'{video_id} is already being encoded, not starting another encode')
+        return
+
     video = db_session.query(models.Video).filter_by(id=video_id).one_or_none()
     video.status = 'encoding'
+    if video.playlist != f'{video.id}/fast.mpd':
+        video.watchable = False
     db_session.commit()
 
     outdir = f"{celery.conf.get('MOVIE_PATH')}/{video.id}"
@@ -341,57 +1671,212 @@ def transcode(self, video_id):
     except FileExistsError:
         pass
 
+    uploader = None
+    lease.hold()
     try:
-        ffmpeg = FfmpegTranscode(video, self, outdir)
-        ffmpeg.run()
-        transcode_video(video, self)
+        ffmpeg = FfmpegTranscode(video, self, outdir, lease)
+        if ffmpeg.direct_play:
+            ffmpeg.run_direct_play()
+            lease.release()
+            return
+
+        if ffmpeg.wants_fast_start():
+            ffmpeg.run_fast_start()
+
+        # The units carry the lease on from here
+        if ffmpeg.wants_units():
+            ffmpeg.run_units()
+            return
+
+        uploader = start_uploader(outdir)
+        if ffmpeg.wants_checkpoints():
+            ffmpeg.run_checkpointed()
+        else:
+            ffmpeg.run()
+        ffmpeg.make_subtitles()
+        ffmpeg.make_thumbnails()
+        ffmpeg.make_poster()
+        transcode_video(video, self, uploader)
+        lease.release()
     except FfmpegException as e:
-        video.status = 'error'
-        video.status_message = str(e)
-        db_session.commit()
+        lease.release()
+        encoding_failed(video, self, str(e))
+    except Ignore:
+        lease.release()
+        raise
+    except Exception as e:
+        # Anything else would leave the video locked until the lease ran out
+        print(f'Encoding {video.id} failed: {e!r}')
+        lease.release()
+        encoding_failed(video, self, 'Encoding failed')
+    finally:
+        lease.stop()
+        if uploader:
+            uploader.stop()
 
-        self.update_state(
-            state = states.FAILURE,
-            meta = str(e)
-        )
+@celery.task(bind=True)
+def transcode_unit(self, unit_id, lease_token=None):
+    unit = db_session.query(models.EncodingUnit).filter_by(id=unit_id).one_or_none()
+    if not unit:
+        print(f'Unit {unit_id} is gone, the encode was split up again')
+        return
 
+    video = db_session.query(models.Video).filter_by(id=unit.video_id).one_or_none()
+    outdir = f"{celery.conf.get('MOVIE_PATH')}/{video.id}"
+
+    lease = VideoLease(video.id, lease_token)
+    if not lease.renew(retake=False):
+        print(f'{video.id} was taken over by another encode, skipping unit {unit_id}')
         raise Ignore()
+    lease.hold()
 
-def transcode_video(video, task):
-    status = 'error'
-    output = ""
+    try:
+        if unit.done:
+            return
+
+        ffmpeg = FfmpegTranscode(video, self, outdir, lease)
+        ffmpeg.run_unit(unit)
+    except FfmpegException as e:
+        if self.request.retries < celery.conf.get('ENCODE_RETRIES'):
+            raise self.retry(countdown=10)
 
+        lease.release()
+        encoding_failed(video, self, str(e))
+    except Ignore:
+        raise
+    except Exception as e:
+        print(f'Encoding unit {unit_id} of {video.id} failed: {e!r}')
+        lease.release()
+        encoding_failed(video, self, 'Encoding failed')
+    finally:
+        lease.stop()
+
+@celery.task(bind=True)
+def finish_units(self, video_id, lease_token=None):
+    video = db_session.query(models.Video).filter_by(id=video_id).one_or_none()
     outdir = f"{celery.conf.get('MOVIE_PATH')}/{video.id}"
+
+    lease = VideoLease(video.id, lease_token)
+    if not lease.renew(retake=False):
+        print(f'{video.id} was taken over by another encode, not finishing it')
+        raise Ignore()
+    lease.hold()
+
+    uploader = None
     try:
-        os.mkdir(outdir)
-    except FileExistsError:
-        pass
+        ffmpeg = FfmpegTranscode(video, self, outdir, lease)
+        uploader = start_uploader(outdir)
+        ffmpeg.merge_units()
+        ffmpeg.make_subtitles()
+        ffmpeg.make_thumbnails()
+        ffmpeg.make_poster()
+        transcode_video(video, self, uploader)
+        lease.release()
+    except FfmpegException as e:
+        lease.release()
+        encoding_failed(video, self, str(e))
+    except Ignore:
+        lease.release()
+        raise
+    except Exception as e:
+        # Anything else would leave the video locked until the lease ran out
+        print(f'Encoding {video.id} failed: {e!r}')
+        lease.release()
+        encoding_failed(video, self, 'Encoding failed')
+    finally:
+        lease.stop()
+        if uploader:
+            uploader.stop()
+
+@celery.task
+def convert_subtitle(subtitle_id):
+    subtitle = db_session.query(models.Subtitle).filter_by(id=subtitle_id).one_or_none()
+    if not subtitle or not subtitle.orig_file:
+        return
+
+    movie_path = celery.conf.get('MOVIE_PATH')
+    outdir = f'{movie_path}/{subtitle.video_id}'
+    os.makedirs(outdir, exist_ok=True)
+
+    filename = f'subtitle_{subtitle.id}.vtt'
+    outfile = f'{outdir}/{filename}'
+
+    with open(os.path.join(movie_path, subtitle.orig_file), 'rb') as f:
+        source_hash = hashlib.sha256(f.read()).hexdigest()
+
+    if subtitle.encoding_hash == source_hash and os.path.exists(outfile):
+        return
+
+    # The same file was uploaded before, for this video or another one
+    converted = False
+    for other in db_session.query(models.Subtitle).filter(models.Subtitle.encoding_hash == source_hash, models.Subtitle.id != subtitle.id).all():
+        if other.encoded_file and os.path.exists(f'{movie_path}/{other.encoded_file}'):
+            print(f'Reusing {other.encoded_file}')
+            link_or_copy(f'{movie_path}/{other.encoded_file}', outfile)
+            converted = True
+            break
+
+    if not converted:
+        command = ['ffmpeg', '-y', '-nostdin', '-i', os.path.join(movie_path, subtitle.orig_file), '-map', '0:s:0', '-c:s', 'webvtt', '-f', 'webvtt', f'{outfile}.tmp']
+        print(f'Executing: {" ".join(command)}')
+        if subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0:
+            print(f'Converting subtitle {subtitle.id} failed')
+            rm_f(f'{outfile}.tmp')
+            return
+        os.replace(f'{outfile}.tmp', outfile)
+
+    subtitle.encoding_hash = source_hash
+    subtitle.encoded_file = f'{subtitle.video_id}/{filename}'
+    db_session.commit()
+
+    if celery.conf.get('STORAGE_BACKEND') == 'S3':
+        get_transfer_engine().upload([outfile])
+
+    # Videos that are already watchable get the track added to their manifest
+    video = db_session.query(models.Video).filter_by(id=subtitle.video_id).one_or_none()
+    if video and video.playlist and video.playlist.endswith('.mpd') and os.path.exists(f'{movie_path}/{video.playlist}'):
+        add_subtitles(video, f'{movie_path}/{video.playlist}')
+        if celery.conf.get('STORAGE_BACKEND') == 'S3':
+            get_transfer_engine().upload([f'{movie_path}/{video.playlist}'])
+
+def mp4box_package(video, outdir, master_playlist, video_files=None, audio_files=None):
+    status = 'error'
+    output = ""
 
-    master_playlist = f"{outdir}/playlist.mpd"
     rm_f(master_playlist)
 
-    dash_size = 4
-    dash_command = ['MP4Box', '-dash', f'{dash_size * 1000}', '-rap', '-frag-rap', '-min-buffer', '16000', '-profile', 'dashavc264:onDemand', '-mpd-title', video.title ,'-out', master_playlist]
+    dash_command = ['MP4Box', '-dash', f'{dash_size * 1000}', '-rap', '-frag-rap', '-min-buffer', '16000', '-mpd-title', video.title ,'-out', master_playlist]
     try:
         print("Reencoded file")
 
+        # Second ladder files are named video_<width>_<rate>_<ladder>.mp4,
+        # keep every ladder together so MP4Box gives each its own adaptation set.
         def sort_video(video):
-            return int(video.split("_")[1])
+            name = os.path.splitext(os.path.basename(video))[0].split("_")
+            return (name[3:], int(name[1]))
 
         def sort_audio(audio):
             return int(audio.split("_")[1].split("k")[0])
 
-        video_files = []
-        encoded_files = db_session.query(models.EncodedFile).filter_by(video_id = video.id, track_type='video').all()
-        for encoded_file in encoded_files:
-            video_files.append(f'{outdir}/{encoded_file.encoded_file_name}')
-        video_files.sort(key=sort_video)
-
-        audio_files = []
-        encoded_files = db_session.query(models.EncodedFile).filter_by(video_id = video.id, track_type='audio').all()
-        for encoded_file in encoded_files:
-            audio_files.append(f'{outdir}/{encoded_file.encoded_file_name}')
-        audio_files.sort(key=sort_audio)
+        if video_files is None:
+            video_files = []
+            encoded_files = db_session.query(models.EncodedFile).filter_by(video_id = video.id, track_type='video').all()
+            for encoded_file in encoded_files:
+                video_files.append(f'{outdir}/{encoded_file.encoded_file_name}')
+            video_files.sort(key=sort_video)
+
+        if audio_files is None:
+            audio_files = []
+            encoded_files = db_session.query(models.EncodedFile).filter_by(video_id = video.id, track_type='audio').all()
+            for encoded_file in encoded_files:
+                audio_files.append(f'{outdir}/{encoded_file.encoded_file_name}')
+            audio_files.sort(key=sort_audio)
+
+        # The AVC interop profile doesn't allow any other video codec
+        if any(f.endswith(f'_{ladder}.mp4') for f in video_files for ladder in extra_ladders):
+            dash_command.extend(['-profile', 'onDemand'])
+        else:
+            dash_command.extend(['-profile', 'dashavc264:onDemand'])
 
         dash_command.extend(video_files)
         dash_command.extend(audio_files)
@@ -409,26 +1894,48 @@ def transcode_video(video, task):
         video.status_message = 'MP4Box failed'
         db_session.commit()
 
-    if celery.conf.get('STORAGE_BACKEND') == "S3":
-        print("Uploading to S3")
+    return status
+
+def transcode_video(video, task, uploader=None):
+    outdir = f"{celery.conf.get('MOVIE_PATH')}/{video.id}"
+    try:
+        os.mkdir(outdir)
+    except FileExistsError:
+        pass
+
+    master_playlist = f"{outdir}/playlist.mpd"
 
-        nthreads = celery.conf.get('S3_UPLOAD_THREADS')
-        g = glob.glob(f"{outdir}/*")
-        splits = numpy.array_split(g, nthreads)
-        threads = list()
+    if celery.conf.get('PACKAGER') == 'ffmpeg':
+        status = 'ready'
+        if not os.path.exists(master_playlist):
+            status = 'error'
+            video.status_message = 'Encoder did not write a manifest'
+    else:
+        status = mp4box_package(video, outdir, master_playlist)
 
-        for index in range(nthreads):
-            x = threading.Thread(target=s3_upload, args=(splits[index].copy(),))
-            threads.append(x)
-            x.start()
+    if status == 'ready':
+        add_subtitles(video, master_playlist)
+
+    if celery.conf.get('STORAGE_BACKEND') == "S3":
+        print("Uploading to S3")
 
-        for index, thread in enumerate(threads):
-            thread.join()
+        # Whatever became final while encoding is already in the bucket, only
+        # the rest and finally the manifest still have to go up.
+        if not uploader:
+            uploader = OutputUploader(outdir)
+        if not uploader.finish(manifest=status == 'ready') and status == 'ready':
+            status = 'error'
+            video.status_message = 'Uploading to S3 failed'
 
         print("Done uploading")
 
-    video.playlist = f'{video.id}/playlist.mpd'
+    # Rooms may be playing the fast start manifest, it stays in place unless
+    # the full one is complete.
     video.encoding_progress = 100
     video.status = status
+    if status == 'ready':
+        video.playlist = f'{video.id}/playlist.mpd'
+        video.watchable = True
     db_session.commit()
+    publish_progress(video)
 
@@ -0,0 +1,130 @@
+import os
+import re
+import json
+import subprocess
+import functools
+
+from watchtogether.util import probe_key
+
+@functools.lru_cache()
+def has_filter(name):
+    output = subprocess.run(['ffmpeg', '-hide_banner', '-filters'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+    return re.search(rf'\s{name}\s', output) is not None
+
+def kbit(rate):
+    return int(rate.rstrip('k'))
+
+class LadderAnalysis:
+    # Encodes a few short samples of a title with every candidate rung and
+    # scores them against the source, so rungs that don't look any better
+    # than the one below them can be left out of the ladder.
+    def __init__(self, conf, source, streamidx, duration, width, height, tmpdir):
+        self.source = source
+        self.streamidx = streamidx
+        self.duration = duration
+        self.width = width
+        self.height = height
+        self.tmpdir = tmpdir
+        self.samples = conf.get('LADDER_SAMPLES')
+        self.sample_length = conf.get('LADDER_SAMPLE_LENGTH')
+        self.cache_file = f'{source}.ladder'
+
+        if has_filter('libvmaf'):
+            self.metric = 'libvmaf'
+            self.min_gain = conf.get('LADDER_MIN_VMAF_GAIN')
+        else:
+            self.metric = 'ssim'
+            self.min_gain = conf.get('LADDER_MIN_SSIM_GAIN')
+
+    def sample_ranges(self):
+        length = min(self.sample_length, self.duration / (self.samples + 1))
+        return [self.duration * (num + 1) / (self.samples + 1) - length / 2 for num in range(self.samples)], length
+
+    def measure(self, sample, start, length):
+        scale = f'scale={self.width}:{self.height}:flags=bicubic,format=yuv420p,setpts=PTS-STARTPTS'
+        command = ['ffmpeg', '-nostdin', '-i', sample, '-ss', f'{start}', '-t', f'{length}', '-i', self.source,
+            '-lavfi', f'[0:v]{scale}[distorted];[1:{self.streamidx}]{scale}[reference];[distorted][reference]{self.metric}', '-f', 'null', '-']
+        output = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True).stderr
+
+        if self.metric == 'libvmaf':
+            match = re.search(r'VMAF score[:=]\s*([\d.]+)', output)
+            return float(match.group(1)) if match else None
+
+        # SSIM is compared in dB, the raw value bunches up right below 1
+        match = re.search(r'SSIM .*All:[\d.]+ \(([\d.]+|inf)\)', output)
+        if not match:
+            return None
+        return float(match.group(1)) if match.group(1) != 'inf' else 100.0
+
+    def score(self, command):
+        starts, length = self.sample_ranges()
+        scores = []
+        peak = 0
+
+        for num, start in enumerate(starts):
+            sample = os.path.join(self.tmpdir, f'sample-{num}.mp4')
+            encode = ['ffmpeg', '-y', '-nostdin', '-ss', f'{start}', '-i', self.source] + command + ['-t', f'{length}', sample]
+            if subprocess.run(encode, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0:
+                return None, None
+
+            peak = max(peak, os.path.getsize(sample) * 8 / length / 1000)
+            score = self.measure(sample, start, length)
+            os.unlink(sample)
+
+            if score is None:
+                return None, None
+            scores.append(score)
+
+        return sum(scores) / len(scores), peak
+
+    def cached(self, key):
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+            if cache['key'] == key:
+                return cache['rungs']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        return None
+
+    def store(self, key, rungs):
+        try:
+            with open(f'{self.cache_file}.tmp', 'w') as f:
+                json.dump({'key': key, 'rungs': rungs}, f)
+            os.replace(f'{self.cache_file}.tmp', self.cache_file)
+        except OSError:
+            pass
+
+    def prune(self, rungs, command_for):
+        key = [probe_key(self.source), self.metric, self.min_gain, self.samples, self.sample_length, [command_for(rung) for rung in rungs]]
+        cached = self.cached(key)
+        if cached is not None:
+            return cached
+
+        kept = []
+        last_score = None
+        for rung in sorted(rungs, key=lambda r: r['width']):
+            score, peak = self.score(command_for(rung))
+            if score is None:
+                print(f'Ladder analysis failed at {rung["width"]}, keeping the full ladder')
+                return rungs
+
+            # The lowest rung is always kept for slow connections
+            if last_score is not None and score - last_score < self.min_gain:
+                print(f'Dropping {rung["width"]} rung: {self.metric} {score:.2f} vs {last_score:.2f}')
+                continue
+
+            # Leave room for scenes the samples missed, but don't let the
+            # encoder spend more than this title has shown it needs.
+            rung = rung.copy()
+            cap = min(kbit(rung['maxrate']), int(peak * 1.5) + 1)
+            rung['bufsize'] = f'{max(int(kbit(rung["bufsize"]) * cap / kbit(rung["maxrate"])), 1)}k'
+            rung['maxrate'] = f'{cap}k'
+
+            print(f'Keeping {rung["width"]} rung: {self.metric} {score:.2f}, capped at {rung["maxrate"]}')
+            kept.append(rung)
+            last_score = score
+
+        self.store(key, kept)
+        return kept
@@ -0,0 +1,193 @@
+import os
+import re
+import math
+import time
+import random
+import hashlib
+import concurrent.futures
+
+import boto3
+import boto3.session
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+MAX_PARTS = 10000
+MIB = 1024 * 1024
+
+def object_key(filename):
+    return "/".join(filename.split("/")[-2:])
+
+class TransferEngine:
+    def __init__(self, conf):
+        self.bucket = conf.get('S3_BUCKET')
+        self.threads = conf.get('S3_UPLOAD_THREADS')
+        self.part_threads = conf.get('S3_PART_THREADS')
+        self.retries = conf.get('S3_UPLOAD_RETRIES')
+        self.multipart_threshold = conf.get('S3_MULTIPART_THRESHOLD')
+        self.multipart_chunksize = conf.get('S3_MULTIPART_CHUNKSIZE')
+        self.poster_max_age = conf.get('POSTER_MAX_AGE')
+
+        params = {
+            'aws_access_key_id': conf.get('S3_ACCESS_KEY'),
+            'aws_secret_access_key': conf.get('S3_SECRET_KEY'),
+        }
+
+        if conf.get('S3_ENDPOINT_URL'):
+            params['endpoint_url'] = conf.get('S3_ENDPOINT_URL')
+
+        if conf.get('S3_REGION'):
+            params['region_name'] = conf.get('S3_REGION')
+
+        # Every file upload can have part_threads parts in flight at once, size
+        # the pool so none of them has to wait for a connection.
+        config = Config(max_pool_connections=self.threads * self.part_threads)
+        session = boto3.session.Session()
+        self.client = session.client('s3', config=config, **params)
+
+    def part_size(self, size):
+        part_size = max(self.multipart_chunksize, math.ceil(size / MAX_PARTS))
+        return math.ceil(part_size / MIB) * MIB
+
+    def etag(self, filename, size):
+        # S3 ETags are the MD5 of the object, or for multipart uploads the MD5
+        # of all the part MD5s followed by the number of parts.
+        part_size = self.part_size(size)
+        digests = []
+
+        with open(filename, 'rb') as f:
+            if size < self.multipart_threshold:
+                return hashlib.md5(f.read()).hexdigest()
+
+            while True:
+                data = f.read(part_size)
+                if not data:
+                    break
+                digests.append(hashlib.md5(data).digest())
+
+        return f'{hashlib.md5(b"".join(digests)).hexdigest()}-{len(digests)}'
+
+    def list_prefix(self, prefix):
+        remote = {}
+
+        try:
+            paginator = self.client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+                for obj in page.get('Contents', []):
+                    remote[obj['Key']] = (obj['Size'], obj['ETag'].strip('"'))
+        except (BotoCoreError, ClientError) as e:
+            print(f'S3: unable to list {prefix}: {e}')
+
+        return remote
+
+    def unchanged(self, filename, size, remote):
+        if not remote or remote[0] != size:
+            return False
+
+        return remote[1] == self.etag(filename, size)
+
+    def extra_args(self, key):
+        args = {'ACL': 'public-read'}
+
+        # Posters are named after their content, a new one gets a new name
+        if re.match(r'^[^/]+/poster-[0-9a-f]+\.jpg$', key):
+            args['CacheControl'] = f'public, max-age={self.poster_max_age}, immutable'
+
+        return args
+
+    def backoff(self, attempt):
+        time.sleep(min(0.5 * 2 ** attempt, 30) * random.uniform(0.5, 1.5))
+
+    def upload_file(self, filename, remote=None):
+        key = object_key(filename)
+        start = time.monotonic()
+
+        try:
+            size = os.path.getsize(filename)
+            if self.unchanged(filename, size, remote):
+                return {'key': key, 'size': size, 'latency': time.monotonic() - start, 'skipped': True}
+        except FileNotFoundError:
+            return {'key': key, 'size': 0, 'latency': 0, 'failed': True}
+
+        config = TransferConfig(
+            multipart_threshold = self.multipart_threshold,
+            multipart_chunksize = self.part_size(size),
+            max_concurrency = self.part_threads,
+        )
+
+        for attempt in range(self.retries):
+            try:
+                self.client.upload_file(filename, self.bucket, key, ExtraArgs=self.extra_args(key), Config=config)
+                break
+            except (BotoCoreError, ClientError, OSError) as e:
+                print(f'S3: upload of {key} failed (attempt {attempt + 1}/{self.retries}): {e}')
+                if attempt + 1 == self.retries:
+                    return {'key': key, 'size': size, 'latency': time.monotonic() - start, 'failed': True}
+                self.backoff(attempt)
+
+        latency = time.monotonic() - start
+        print(f'S3: uploaded {key} ({size} bytes) in {latency:.2f}s')
+
+        return {'key': key, 'size': size, 'latency': latency}
+
+    def upload(self, files, remote=None):
+        # Largest files go first so the threads pulling from the queue end up
+        # with about the same number of bytes each, not the same number of files.
+        def size(filename):
+            try:
+                return os.path.getsize(filename)
+            except FileNotFoundError:
+                return 0
+
+        files = sorted(files, key=size, reverse=True)
+        start = time.monotonic()
+
+        # One listing per directory tells us the size and ETag of everything
+        # that is already there, unchanged files are skipped. Callers that
+        # upload the same directory again and again pass their own listing.
+        if remote is None:
+            remote = {}
+            for prefix in set(object_key(f).rsplit('/', 1)[0] + '/' for f in files):
+                remote.update(self.list_prefix(prefix))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(self.threads, len(files)))) as pool:
+            results = list(pool.map(lambda f: self.upload_file(f, remote.get(object_key(f))), files))
+
+        elapsed = max(time.monotonic() - start, 0.001)
+        uploaded = [r for r in results if not r.get('skipped') and not r.get('failed')]
+        latencies = sorted(r['latency'] for r in uploaded)
+        stats = {
+            'uploaded': len(uploaded),
+            'skipped': len([r for r in results if r.get('skipped')]),
+            'failed': len([r for r in results if r.get('failed')]),
+            'failed_keys': [r['key'] for r in results if r.get('failed')],
+            'bytes': sum(r['size'] for r in uploaded),
+            'seconds': elapsed,
+            'latency_p50': latencies[len(latencies) // 2] if latencies else 0,
+            'latency_max': latencies[-1] if latencies else 0,
+        }
+        stats['throughput'] = stats['bytes'] / elapsed
+
+        print(f"S3: {stats['uploaded']} uploaded, {stats['skipped']} unchanged, {stats['failed']} failed, "
+            f"{stats['bytes'] / MIB:.1f} MiB in {elapsed:.1f}s ({stats['throughput'] / MIB:.1f} MiB/s), "
+            f"latency p50 {stats['latency_p50']:.2f}s max {stats['latency_max']:.2f}s")
+
+        return stats
+
+    def list_directories(self):
+        directories = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Delimiter='/'):
+            for prefix in page.get('CommonPrefixes', []):
+                directories.append(prefix['Prefix'].rstrip('/'))
+
+        return directories
+
+    def delete_prefix(self, prefix, rate=0):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            objects = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+            if objects:
+                self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': objects, 'Quiet': True})
+                if rate:
+                    time.sleep(len(objects) / rate)
@@ -1,3 +1,3 @@
-__all__ = ['random_string', 'rm_f', 'ffprobe', 'is_video_file', 'get_video_title']
+__all__ = ['random_string', 'rm_f', 'unlink_tree', 'fallocate', 'link_or_copy', 'upload_key', 'ffprobe', 'get_keyframes', 'is_video_file', 'index_first', 'get_video_title']
   
 from .util import *
@@ -1,8 +1,12 @@
 import os
 import random
 import string
+import time
 import json
+import ctypes
 import pprint
+import shutil
+import subprocess
 
 pp = pprint.PrettyPrinter(indent=4)
 
@@ -18,13 +22,146 @@ def rm_f(filename):
     except TypeError:
         pass
 
-def ffprobe(filename):
-    cmd = f'ffprobe -v quiet -show_streams -show_format -print_format json {filename}'
-    streaminfo = os.popen(cmd).read()
-    return json.loads(streaminfo)
+def unlink_tree(path, rate=0):
+    # Unlinks in batches of 100, sleeping in between so a large tree is
+    # removed at roughly rate unlinks per second instead of all at once.
+    count = 0
 
-def is_video_file(filename):
-    streaminfo = ffprobe(filename)
+    def throttle():
+        nonlocal count
+        count = count + 1
+        if rate and count % 100 == 0:
+            time.sleep(100 / rate)
+
+    if not os.path.isdir(path) or os.path.islink(path):
+        rm_f(path)
+        return
+
+    for root, dirs, files in os.walk(path, topdown=False):
+        for name in files:
+            rm_f(os.path.join(root, name))
+            throttle()
+
+        for name in dirs:
+            try:
+                os.rmdir(os.path.join(root, name))
+            except NotADirectoryError:
+                rm_f(os.path.join(root, name))
+            except OSError:
+                pass
+
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
+
+def fallocate(fd, length):
+    # Call fallocate(2) directly, posix_fallocate would fall back to writing
+    # zeroes over the whole file on filesystems that don't support it.
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.fallocate(fd, 0, ctypes.c_longlong(0), ctypes.c_longlong(length)) == 0:
+            return
+    except (OSError, AttributeError):
+        pass
+
+    os.ftruncate(fd, length)
+
+def link_or_copy(source, destination):
+    rm_f(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+def upload_key(video_id, upload_identifier):
+    return f'upload:{video_id}:{upload_identifier}'
+
+def probe_key(filename):
+    st = os.stat(filename)
+    return [os.path.abspath(filename), st.st_ino, st.st_size, st.st_mtime_ns]
+
+def ffprobe(filename, cache=True):
+    # Probe results are kept next to the file and reused for as long as the
+    # file is the same one, with the same size and modification time. Files
+    # that are still being written into keep their size and may keep their
+    # mtime, those are never cached.
+    filename = str(filename)
+    cache_file = f'{filename}.probe'
+    key = probe_key(filename)
+
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if cache and cached['key'] == key:
+            return cached['streaminfo']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    cmd = ['ffprobe', '-v', 'quiet', '-show_streams', '-show_format', '-print_format', 'json', filename]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+
+    try:
+        streaminfo = json.loads(result.stdout)
+    except ValueError:
+        streaminfo = {}
+
+    # A failed probe may not fail the next time, it is never remembered
+    if not cache or result.returncode != 0 or 'format' not in streaminfo:
+        return streaminfo
+
+    try:
+        with open(f'{cache_file}.tmp', 'w') as f:
+            json.dump({'key': key, 'streaminfo': streaminfo}, f)
+        os.replace(f'{cache_file}.tmp', cache_file)
+    except OSError:
+        pass
+
+    return streaminfo
+
+def get_keyframes(filename, streamidx, cache=True):
+    # Scanning every packet reads the whole file, the result is kept next to
+    # it the same way probe results are.
+    filename = str(filename)
+    cache_file = f'{filename}.keyframes'
+    key = probe_key(filename) + [streamidx]
+
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if cache and cached['key'] == key:
+            return cached['keyframes']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    cmd = ['ffprobe', '-v', 'quiet', '-select_streams', f'{streamidx}', '-show_entries', 'packet=pts_time,flags', '-print_format', 'csv=p=0', filename]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+
+    keyframes = []
+    for line in result.stdout.splitlines():
+        try:
+            pts_time, flags = line.split(',')[:2]
+            if 'K' in flags:
+                keyframes.append(float(pts_time))
+        except ValueError:
+            pass
+
+    keyframes.sort()
+
+    if not cache or result.returncode != 0:
+        return keyframes
+
+    try:
+        with open(f'{cache_file}.tmp', 'w') as f:
+            json.dump({'key': key, 'keyframes': keyframes}, f)
+        os.replace(f'{cache_file}.tmp', cache_file)
+    except OSError:
+        pass
+
+    return keyframes
+
+def is_video_file(filename, cache=True):
+    streaminfo = ffprobe(filename, cache)
     try:
         if 'probe_score' in streaminfo['format']:
             if streaminfo['format']['probe_score'] < 25:
@@ -36,8 +173,33 @@ def is_video_file(filename):
 
     return True
 
-def get_video_title(filename):
-    streaminfo = ffprobe(filename)
+def index_first(filename, length):
+    # Walks the top level boxes of an MP4 file up to length bytes and tells
+    # whether the moov box comes before the media data.
+    offset = 0
+    with open(filename, 'rb') as f:
+        while offset + 8 <= length:
+            f.seek(offset)
+            header = f.read(16)
+            if len(header) < 8:
+                return False
+
+            size = int.from_bytes(header[0:4], 'big')
+            box = header[4:8]
+            if size == 1 and len(header) == 16:
+                size = int.from_bytes(header[8:16], 'big')
+
+            if box == b'moov':
+                return True
+            if box == b'mdat' or size < 8:
+                return False
+
+            offset = offset + size
+
+    return False
+
+def get_video_title(filename, cache=True):
+    streaminfo = ffprobe(filename, cache)
     try:
         return streaminfo['format']['tags']['title']
     except KeyError: